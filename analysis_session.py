@@ -0,0 +1,201 @@
+"""
+Interactive re-analysis of one recording. An AnalysisSession decodes the
+file once and keeps the spectrogram frames and spectral peaks computed
+for each band. Viewing a new time window only computes the frames that
+have not been seen yet (none, if the window was viewed before). The
+filtered signal is not kept for the whole recording: each view filters
+just its own samples, starting a short warm-up margin before them so
+the filter has settled, so changing the band costs the same at any
+point in the recording.
+
+Usage:
+    session = AnalysisSession('test_files/Test_Audio/stridor_sounds.wav')
+    session.render([0, 2], [100, 2000])
+    session.render([1, 3], [100, 2000])    # reuses frames from 1 to 2 s
+"""
+
+from collections import OrderedDict
+import numpy as np
+from sound_analysis import readFile, resolveStartStop, designBandpass, stft, findSpectralPeaks
+from sound_analysis import amplitudeEnvelope, renderAnalysis, AnalysisResult
+from sound_analysis import NPERSEG, NOVERLAP, SPEC_WINDOW, N_SPECTRAL_PEAKS
+from time_index import TimeAxis
+# scipy is imported on first use (see lazy_imports.py)
+from lazy_imports import LazyModule
+signal = LazyModule('scipy.signal')
+
+# Bands whose results are kept at once (least recently viewed dropped first)
+SESSION_MAX_BANDS = 4
+# Time constants of a band's slowest filter pole filtered before a view,
+# so the filter's start-up transient has died away (to about 1e-9)
+SESSION_WARMUP = 20
+
+
+class BandState:
+    """
+    Everything computed so far for one band of a session: frames & peaks
+    wherever *computed* is True, and the filtered samples of the latest
+    view (from sample *filtered_start*).
+    """
+
+    def __init__(self, audio_freqs, samples, sample_rate, n_freqs, n_frames):
+        self.sos = designBandpass(audio_freqs, sample_rate)
+        # Samples for the start-up transient to decay by SESSION_WARMUP
+        # time constants of the slowest pole
+        radius = np.abs(signal.sos2zpk(self.sos)[1]).max()
+        self.warmup = int(np.ceil(SESSION_WARMUP / -np.log(radius)))
+        channels = samples.shape[:-1]
+        self.filtered = np.empty(channels + (0,))
+        self.filtered_start = 0
+        # Pages are only touched (and take memory) once frames are written
+        self.spectrogram = np.empty(channels + (n_freqs, n_frames))
+        self.peak_freqs = np.full(channels + (n_frames, N_SPECTRAL_PEAKS), np.nan)
+        self.peak_intensities = np.full(channels + (n_frames, N_SPECTRAL_PEAKS), np.nan)
+        self.computed = np.zeros(n_frames, dtype=bool)
+
+
+class AnalysisSession:
+    """
+    Cached, incremental analysis of one wav file (see module docstring).
+    """
+
+    def __init__(self, filename, channels=None, nperseg=NPERSEG, noverlap=NOVERLAP):
+        self.filename = filename
+        self.sample_rate, self.samples, self.audio_length, _, _ = readFile(filename, [0, None], channels)
+        self.nperseg = nperseg
+        self.hop = nperseg - noverlap
+
+        n_samples = self.samples.shape[-1]
+        self.n_frames = max((n_samples - nperseg) // self.hop + 1, 0)
+        # Center time of every frame, as from spectralAnalysis
+        self.times = (nperseg / 2 + np.arange(self.n_frames) * self.hop) / self.sample_rate
+        self.frequencies = np.fft.rfftfreq(nperseg, 1 / self.sample_rate)
+
+        self.bands = OrderedDict()
+        # Work done so far, for checking what a view had to compute
+        self.samples_filtered = 0
+        self.frames_computed = 0
+
+    def band(self, audio_freqs):
+        """
+        Return the BandState of a band, creating it if needed.
+        """
+        key = (float(audio_freqs[0]), float(audio_freqs[1]))
+        if key not in self.bands:
+            self.bands[key] = BandState(audio_freqs, self.samples, self.sample_rate,
+                self.frequencies.shape[0], self.n_frames)
+            while len(self.bands) > SESSION_MAX_BANDS:
+                self.bands.popitem(last=False)
+        self.bands.move_to_end(key)
+
+        return self.bands[key]
+
+    def filterRange(self, state, start, stop):
+        """
+        Make the filtered samples of a band cover samples start to stop.
+        Filtering starts state.warmup samples early, from rest (as
+        butterBandpass does at the start of the file), and only the
+        samples from *start* on are kept.
+        """
+        filtered_stop = state.filtered_start + state.filtered.shape[-1]
+        if state.filtered_start <= start and stop <= filtered_stop:
+            return
+
+        warmup_start = max(start - state.warmup, 0)
+        filtered = signal.sosfilt(state.sos, self.samples[..., warmup_start:stop])
+        state.filtered = filtered[..., start - warmup_start:]
+        state.filtered_start = start
+        self.samples_filtered += stop - warmup_start
+
+    def frameRange(self, audio_startstop):
+        """
+        Return the (first, last + 1) frames whose centers are within
+        audio_startstop, plus one either side so the view is covered.
+        """
+        first = int(np.searchsorted(self.times, audio_startstop[0], side='left')) - 1
+        last = int(np.searchsorted(self.times, audio_startstop[1], side='right')) + 1
+
+        return max(first, 0), min(last, self.n_frames)
+
+    def computeFrames(self, state, first, last):
+        """
+        Compute the spectrogram frames & peaks of a band between frames
+        first and last that have not been computed yet, from its filtered
+        samples (see filterRange).
+        """
+        missing = np.flatnonzero(~state.computed[first:last]) + first
+        if missing.size == 0:
+            return
+
+        # Split the missing frames into runs of consecutive frames
+        breaks = np.flatnonzero(np.diff(missing) > 1) + 1
+        for run in np.split(missing, breaks):
+            start, stop = run[0], run[-1] + 1
+            sample_start = start * self.hop - state.filtered_start
+            sample_stop = (stop - 1) * self.hop + self.nperseg - state.filtered_start
+
+            _, _, spectrogram = stft(state.filtered[..., sample_start:sample_stop], self.sample_rate,
+                self.nperseg, self.nperseg - self.hop, SPEC_WINDOW)
+            peak_freqs, peak_intensities = findSpectralPeaks(spectrogram, self.frequencies)
+
+            state.spectrogram[..., start:stop] = spectrogram
+            state.peak_freqs[..., start:stop, :] = peak_freqs
+            state.peak_intensities[..., start:stop, :] = peak_intensities
+            state.computed[start:stop] = True
+            self.frames_computed += stop - start
+
+    def view(self, audio_startstop, audio_freqs):
+        """
+        Return an AnalysisResult covering audio_startstop (in s) for the
+        band audio_freqs, computing only what has not been computed
+        before. Arrays are views of the session's caches. The amplitude
+        envelope is scaled to the largest sample of the window.
+        """
+        audio_startstop = resolveStartStop(list(audio_startstop), self.audio_length)
+        audio_startstop[0] = float(audio_startstop[0])
+        state = self.band(audio_freqs)
+        first, last = self.frameRange(audio_startstop)
+
+        # Filter the samples of the window and of any frames not computed yet
+        n_samples = self.samples.shape[-1]
+        start = min(int(audio_startstop[0] * self.sample_rate), n_samples)
+        stop = min(int(np.ceil(audio_startstop[1] * self.sample_rate)), n_samples)
+        missing = np.flatnonzero(~state.computed[first:last]) + first
+        if missing.size:
+            start = min(start, missing[0] * self.hop)
+            stop = max(stop, missing[-1] * self.hop + self.nperseg)
+        self.filterRange(state, start, stop)
+        self.computeFrames(state, first, last)
+        envelope_times, envelope = self.envelope(state, audio_startstop)
+
+        return AnalysisResult(self.filename, self.sample_rate, self.audio_length, audio_startstop, list(audio_freqs),
+            self.frequencies, self.times[first:last], state.spectrogram[..., first:last],
+            state.peak_freqs[..., first:last, :], state.peak_intensities[..., first:last, :],
+            envelope_times, envelope)
+
+    def envelope(self, state, audio_startstop):
+        """
+        Return the downsampled amplitude of the filtered signal within
+        audio_startstop (see amplitudeEnvelope).
+        """
+        n_samples = self.samples.shape[-1]
+        start = min(int(audio_startstop[0] * self.sample_rate), n_samples)
+        stop = min(int(np.ceil(audio_startstop[1] * self.sample_rate)), n_samples)
+        time_axis = TimeAxis(self.sample_rate, stop - start, start)
+        samples = state.filtered[..., start - state.filtered_start:stop - state.filtered_start]
+
+        # decimate's anti-aliasing filter (order 8, run forwards &
+        # backwards) needs more than 27 samples
+        if samples.shape[-1] <= 27:
+            return time_axis.times, samples / np.max(samples, axis=-1, keepdims=True)
+
+        return amplitudeEnvelope(time_axis.times, samples)
+
+    def render(self, audio_startstop, audio_freqs):
+        """
+        Plot a view of the session (see renderAnalysis).
+        """
+        result = self.view(audio_startstop, audio_freqs)
+        renderAnalysis(result)
+
+        return result
@@ -0,0 +1,227 @@
+"""
+Batch spectral analysis of a directory (or glob) of wav files. Each file
+is read, band-pass filtered, turned into a spectrogram and reduced to its
+spectral peaks in a pool of worker processes. Nothing is plotted; the
+peaks of each file, and the tracks they form (see peak_tracks.py), are
+saved to a compressed .npz file and a timing summary is printed for
+every file.
+
+Usage:
+    python3 batch_analysis.py 'test_files/Test_Audio' 100 2000 -o peaks -w 4
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from sound_analysis import readFile, decimateToBand, butterBandpass, spectralAnalysis, findSpectralPeaks
+from sound_analysis import NPERSEG, NOVERLAP, LOW_PRECISION_DTYPE, DOWNMIX_STRATEGIES
+from peak_tracks import trackPeaks
+from profiling import Profiler, profileStage, mergeTraces, summarizeTrace, printSummary as printTraceSummary
+
+# Stages timed for every file, in the order they are run
+STAGES = ('read', 'filter', 'spectrogram', 'peaks', 'save')
+
+
+def findWavFiles(path):
+    """
+    Given a directory or a glob pattern, return a sorted list of
+    the wav files it refers to.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.wav')
+
+    return sorted(glob.glob(path))
+
+
+def outputNames(filenames):
+    """
+    Return the output name of each file: its path relative to the
+    directory shared by all of them, without the extension. Files with
+    the same name in different directories thus get different outputs.
+    """
+    filenames = [os.path.abspath(filename) for filename in filenames]
+    if not filenames:
+        return []
+    root = os.path.commonpath([os.path.dirname(filename) for filename in filenames])
+
+    return [os.path.splitext(os.path.relpath(filename, root))[0] for filename in filenames]
+
+
+def analyzeFile(filename, audio_freqs, output_dir, profile=False, dtype=None, channels=None,
+        decimate=False, zero_phase=False, name=None):
+    """
+    Run the read -> filter -> spectrogram -> peak finding & tracking
+    chain on one file and save the peak & track tables to *output_dir*. Returns the file name,
+    the number of spectrogram frames and the time (in s) of each stage.
+    With *profile*, a Chrome trace of the file's stages (see profiling.py)
+    is saved next to the peak table. *dtype* sets the precision of the
+    filter and spectrogram (see sound_analysis.butterBandpass), and
+    *channels* which channels are analysed (see selectChannels); with
+    'all', the saved peak tables have a leading channel axis.
+    *decimate* & *zero_phase* are as for sound_analysis.analyze; time
+    spent decimating is counted in the filter stage. Outputs are named
+    *name* (see outputNames; by default, the file name).
+    """
+    # Name the output after the file name, not the file path
+    if name is None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+    os.makedirs(os.path.dirname(os.path.join(output_dir, name)), exist_ok=True)
+
+    if profile:
+        with Profiler() as profiler:
+            with profiler.stage('analyzeFile') as stage:
+                stage.info(filename=filename)
+                result = analyzeFile(filename, audio_freqs, output_dir, dtype=dtype, channels=channels,
+                    decimate=decimate, zero_phase=zero_phase, name=name)
+        profiler.save(os.path.join(output_dir, f'{name}.trace.json'))
+        return result
+
+    timings = {}
+
+    start = time.perf_counter()
+    with profileStage('read') as stage:
+        sample_rate, samples, audio_length, time_array, _ = readFile(filename, [0, None], channels)
+        stage.arrays(samples=samples)
+    timings['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    factor = 1
+    if decimate:
+        with profileStage('decimate') as stage:
+            samples, sample_rate, factor = decimateToBand(samples, audio_freqs, sample_rate)
+            stage.arrays(samples=samples)
+    with profileStage('filter') as stage:
+        samples = butterBandpass(samples, audio_freqs, sample_rate, dtype, zero_phase=zero_phase)
+        stage.arrays(samples=samples)
+    timings['filter'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with profileStage('spectrogram') as stage:
+        frequencies, times, spectrogram = spectralAnalysis(samples, sample_rate, NPERSEG // factor, NOVERLAP // factor)
+        stage.arrays(spectrogram=spectrogram)
+    timings['spectrogram'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with profileStage('peaks') as stage:
+        peak_freqs, peak_intensities = findSpectralPeaks(spectrogram, frequencies)
+        stage.arrays(peak_freqs=peak_freqs, peak_intensities=peak_intensities)
+    with profileStage('tracks') as stage:
+        tracks, _ = trackPeaks(times, peak_freqs, peak_intensities)
+        stage.arrays(start=tracks['start'])
+    timings['peaks'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with profileStage('save'):
+        np.savez_compressed(os.path.join(output_dir, f'{name}.npz'),
+            times = times,
+            peak_freqs = peak_freqs,
+            peak_intensities = peak_intensities,
+            sample_rate = sample_rate,
+            audio_length = audio_length,
+            audio_freqs = audio_freqs,
+            **{f'track_{column}': values for column, values in tracks.items()})
+    timings['save'] = time.perf_counter() - start
+
+    return filename, times.shape[0], timings
+
+
+def runBatch(filenames, audio_freqs, output_dir, workers=None, profile=False, dtype=None, channels=None,
+        decimate=False, zero_phase=False):
+    """
+    Analyse every file in *filenames* across a pool of *workers*
+    processes (defaults to the number of CPUs). Returns a list of
+    analyzeFile results in the order the files finished, and a list of
+    (filename, error message) for the files that could not be analysed.
+    One bad file does not stop the rest of the batch.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyzeFile, filename, audio_freqs, output_dir, profile, dtype, channels,
+            decimate, zero_phase, name): filename for filename, name in zip(filenames, outputNames(filenames))}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                failures.append((futures[future], f'{type(error).__name__}: {error}'))
+
+    return results, failures
+
+
+def printSummary(results):
+    """
+    Print the per-stage and total processing time of each file.
+    """
+    names = outputNames([filename for filename, _, _ in results])
+    width = max([len(name) for name in names] + [len('file')])
+
+    header = [f'{"file":<{width}}', 'frames'] + list(STAGES) + ['total']
+    print('  '.join(f'{col:>12}' for col in header))
+
+    for name, (_, n_frames, timings) in zip(names, results):
+        row = [f'{name:<{width}}', n_frames]
+        row += [f'{timings[stage]:.3f}' for stage in STAGES]
+        row.append(f'{sum(timings.values()):.3f}')
+        print('  '.join(f'{col:>12}' for col in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch spectral peak extraction for wav files.')
+    parser.add_argument('path', help='Directory of wav files, or a glob pattern.')
+    parser.add_argument('min_freq', type=int, help='Low cut of the band-pass filter (Hz).')
+    parser.add_argument('max_freq', type=int, help='High cut of the band-pass filter (Hz).')
+    parser.add_argument('-o', '--output-dir', default='batch_output', help='Where to write the .npz peak tables.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes (default: all CPUs).')
+    parser.add_argument('-c', '--channels', default=None,
+        help="Channel of multi-channel files to analyse, 'all', or a downmix ('mean' or 'loudest'). Default: channel 1.")
+    parser.add_argument('--decimate', action='store_true', help='Lower the sample rate to just above the band first.')
+    parser.add_argument('--zero-phase', action='store_true', help='Filter forwards & backwards (no phase delay).')
+    parser.add_argument('--float32', action='store_true', help='Filter & transform in float32 to halve memory use.')
+    parser.add_argument('--profile', metavar='TRACE', help='Profile every file and write the merged Chrome trace here.')
+    args = parser.parse_args()
+
+    # Filter the minimum passed-in frequency.
+    if args.min_freq == 0:
+        raise Exception("Minimum frequency must be at least 1.")
+
+    filenames = findWavFiles(args.path)
+    if not filenames:
+        raise Exception(f"No wav files found at {args.path}.")
+
+    start = time.perf_counter()
+    dtype = LOW_PRECISION_DTYPE if args.float32 else None
+    channels = int(args.channels) if args.channels is not None and args.channels.isdigit() else args.channels
+    if channels not in (None, 'all') + DOWNMIX_STRATEGIES and not isinstance(channels, int):
+        raise Exception(f"Unknown channels option {args.channels}.")
+
+    results, failures = runBatch(filenames, [args.min_freq, args.max_freq], args.output_dir, args.workers,
+        args.profile is not None, dtype, channels, args.decimate, args.zero_phase)
+    elapsed = time.perf_counter() - start
+
+    printSummary(results)
+    for filename, error in failures:
+        print(f'FAILED {filename}: {error}', file=sys.stderr)
+
+    if args.profile:
+        # One trace per analysed file, merged into a single timeline
+        analysed = {filename for filename, _, _ in results}
+        trace_files = [os.path.join(args.output_dir, name + '.trace.json')
+            for filename, name in zip(filenames, outputNames(filenames)) if filename in analysed]
+        trace = mergeTraces(trace_files)
+        with open(args.profile, 'w') as f:
+            json.dump(trace, f)
+        printTraceSummary(summarizeTrace(trace), file=sys.stderr)
+    print(f'{len(results)} files in {elapsed:.3f} s', file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Benchmarks for every stage of the sound & respiration analysis, run over
+the bundled test files and synthetic recordings of 1 min, 1 h and 8 h.
+Each stage reports its best wall time over a few repeats, its throughput
+in samples/s and its peak memory (tracemalloc, in a separate run so it
+does not slow the timed runs). Recordings longer than STREAM_SECONDS
+are run through the streaming stages instead, so memory use stays flat.
+The import time of each command line module is measured in a fresh
+interpreter and held to STARTUP_BUDGET. Results can be saved as a JSON
+baseline, and later runs compared against it to flag regressions.
+
+Usage:
+    python3 benchmarks.py --save baseline.json
+    python3 benchmarks.py --compare baseline.json --sizes 1m 1h
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import wave
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from sound_analysis import readFile, readWindow, readBlocks, streamBandpass, streamAnalysis, butterBandpass, spectralAnalysis, findSpectralPeaks, doAnalysis
+from respiration_phase import readRespData, runningMean, calcDifferential, findRespiratoryPhase
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files')
+# Length (in s) of each synthetic recording size
+SYNTHETIC_SIZES = {'1m': 60, '1h': 3600, '8h': 8 * 3600}
+SYNTHETIC_SAMPLE_RATE = 44100
+# FSR readings per second of the synthetic respiration logs
+SYNTHETIC_RESP_RATE = 50
+# Band used by the filtering stages
+BENCH_FREQS = [100, 2000]
+# Recordings longer than this (in s) are benchmarked block by block
+STREAM_SECONDS = 600
+# Timed runs per stage (the best is kept)
+REPEATS = 3
+# Allowed slowdown / memory growth over the baseline before flagging
+TOLERANCE = 0.25
+# Modules behind the command line tools, timed from a fresh interpreter
+STARTUP_MODULES = ('sound_analysis', 'respiration_phase', 'batch_analysis', 'live_analysis', 'live_respiration', 'feature_store')
+# Most time (s) importing any of them may take
+STARTUP_BUDGET = 1.0
+# Modules that should only be imported once something is plotted or computed
+LAZY_MODULES = ('matplotlib', 'scipy.signal', 'scipy.io', 'scipy.ndimage', 'scipy.fft')
+
+
+def writeSyntheticWav(filename, seconds, sample_rate=SYNTHETIC_SAMPLE_RATE, seed=0):
+    """
+    Write a mono 16-bit wav of breathing-like noise bursts with a
+    stridor-like tone, one second at a time (so 8 h files fit in memory).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(sample_rate) / sample_rate
+
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for second in range(int(seconds)):
+            # Breaths every 4 s, with a 500 Hz tone during inspiration
+            breath = np.sin(np.pi * ((second + t) % 4) / 4) ** 2
+            tone = np.sin(2 * np.pi * 500 * t) * (((second + t) % 4) < 2)
+            block = 3000 * breath * (rng.normal(size=sample_rate) + tone)
+            f.writeframes(np.clip(block, -32768, 32767).astype('<i2').tobytes())
+
+
+def writeSyntheticResp(filename, seconds, sample_rate=SYNTHETIC_RESP_RATE, seed=0):
+    """
+    Write a 'millis; value' FSR log of breathing at 15 breaths/min.
+    """
+    rng = np.random.default_rng(seed)
+    millis = np.cumsum(1000 // sample_rate + rng.integers(0, 3, int(seconds * sample_rate)))
+    vals = np.round(200 + 150 * np.sin(2 * np.pi * 0.25 * millis / 1000) + rng.normal(0, 5, millis.shape[0]))
+    np.savetxt(filename, np.column_stack((millis, vals)), fmt='%d', delimiter='; ')
+
+
+def soundCases(filename):
+    """
+    Return (stage, n_samples, function) for every sound analysis stage
+    of a wav file. Each stage's inputs are prepared up front so only the
+    stage itself is measured. Recordings longer than STREAM_SECONDS
+    get streamCases instead.
+    """
+    # Only the header is read to find the length
+    sample_rate, samples, audio_length, _, _ = readWindow(filename, [0, None])
+    if audio_length > STREAM_SECONDS:
+        return streamCases(filename, samples.shape[0])
+
+    sample_rate, samples, audio_length, time_array, _ = readFile(filename, [0, None])
+    filtered = butterBandpass(samples, BENCH_FREQS, sample_rate)
+    frequencies, times, spectrogram = spectralAnalysis(filtered, sample_rate)
+    n = samples.shape[0]
+
+    def fullAnalysis():
+        doAnalysis(filename, [0, None], BENCH_FREQS)
+        plt.close('all')
+
+    return [
+        ('readFile', n, lambda: readFile(filename, [0, None])),
+        ('butterBandpass', n, lambda: butterBandpass(samples, BENCH_FREQS, sample_rate)),
+        ('spectralAnalysis', n, lambda: spectralAnalysis(filtered, sample_rate)),
+        ('findSpectralPeaks', n, lambda: findSpectralPeaks(spectrogram, frequencies)),
+        ('doAnalysis', n, fullAnalysis),
+    ]
+
+
+def streamCases(filename, n):
+    """
+    Return (stage, n_samples, function) for the streaming stages of a
+    long wav file, each holding one block at a time. Each stage includes
+    the ones before it (reading, then filtering, then the full analysis).
+    """
+    def consume(generator):
+        for _ in generator:
+            pass
+
+    def filterBlocks():
+        sample_rate, blocks = readBlocks(filename)
+        consume(streamBandpass(blocks, BENCH_FREQS, sample_rate))
+
+    return [
+        ('readBlocks', n, lambda: consume(readBlocks(filename)[1])),
+        ('streamBandpass', n, filterBlocks),
+        ('streamAnalysis', n, lambda: consume(streamAnalysis(filename, BENCH_FREQS))),
+    ]
+
+
+def respCases(filename):
+    """
+    Return (stage, n_samples, function) for the respiration stages.
+    """
+    with redirect_stdout(io.StringIO()):
+        vals, time_list = readRespData(filename)
+    diff, diff_time_vals = calcDifferential(runningMean(vals), time_list)
+    n = vals.shape[0]
+
+    return [
+        ('readRespData', n, lambda: readRespData(filename)),
+        ('findRespiratoryPhase', n, lambda: findRespiratoryPhase(diff, diff_time_vals)),
+    ]
+
+
+def measure(function, repeats=REPEATS):
+    """
+    Return the best wall time (s) of *repeats* calls and the
+    peak traced memory (bytes) of one more call. Anything the
+    stage prints (e.g. readRespData's Hz warning) is discarded.
+    """
+    times = []
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+def measureStartup(module, repeats=REPEATS):
+    """
+    Return the best time (s) to import *module* in a fresh interpreter,
+    and the LAZY_MODULES that importing it pulled in.
+    """
+    code = ('import sys, time, json; start = time.perf_counter(); import {0}; '
+        'print(json.dumps([time.perf_counter() - start, [name for name in {1!r} if name in sys.modules]]))')
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code.format(module, LAZY_MODULES)], check=True,
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        seconds, loaded = json.loads(output)
+        times.append(seconds)
+
+    return min(times), loaded
+
+
+def benchmarkInputs(sizes, tmp_dir):
+    """
+    Yield (input name, case list) for the bundled test files and
+    for synthetic recordings of each of *sizes*.
+    """
+    audio_dir = os.path.join(TEST_FILES_DIR, 'Test_Audio')
+    for name in sorted(os.listdir(audio_dir)):
+        yield name, soundCases(os.path.join(audio_dir, name))
+
+    resp_dir = os.path.join(TEST_FILES_DIR, 'Test_Breathing_Data')
+    for name in sorted(os.listdir(resp_dir)):
+        yield name, respCases(os.path.join(resp_dir, name))
+
+    for size in sizes:
+        wav_filename = os.path.join(tmp_dir, f'synthetic_{size}.wav')
+        writeSyntheticWav(wav_filename, SYNTHETIC_SIZES[size])
+        yield f'synthetic_{size}.wav', soundCases(wav_filename)
+        os.remove(wav_filename)
+
+        resp_filename = os.path.join(tmp_dir, f'synthetic_{size}.txt')
+        writeSyntheticResp(resp_filename, SYNTHETIC_SIZES[size])
+        yield f'synthetic_{size}.txt', respCases(resp_filename)
+        os.remove(resp_filename)
+
+
+def runBenchmarks(sizes, repeats=REPEATS):
+    """
+    Run every stage over every input. Returns a dict keyed by
+    'stage:input' of seconds, samples/s and peak memory.
+    """
+    results = {}
+    for module in STARTUP_MODULES:
+        seconds, loaded = measureStartup(module, repeats)
+        results[f'import:{module}'] = {'seconds': seconds, 'peak_bytes': 0}
+        print(f'{"import":>22} {module:>22} {seconds * 1000:10.2f} ms' + (f'  loads {", ".join(loaded)}' if loaded else ''))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for input_name, cases in benchmarkInputs(sizes, tmp_dir):
+            for stage, n_samples, function in cases:
+                seconds, peak = measure(function, repeats)
+                results[f'{stage}:{input_name}'] = {
+                    'seconds': seconds,
+                    'samples_per_second': n_samples / seconds if seconds > 0 else float('inf'),
+                    'peak_bytes': peak,
+                }
+                print(f'{stage:>22} {input_name:>22} {seconds * 1000:10.2f} ms '
+                    f'{n_samples / max(seconds, 1e-12) / 1e6:10.2f} Msamples/s {peak / 2 ** 20:10.1f} MiB')
+
+    return results
+
+
+def compareBaseline(results, baseline, tolerance=TOLERANCE):
+    """
+    Return a list of messages for every benchmark that is slower, or
+    uses more memory, than its baseline by more than *tolerance*.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if result[metric] > baseline[key][metric] * (1 + tolerance):
+                regressions.append(f'{key} {metric}: {baseline[key][metric]:.4g} -> {result[metric]:.4g}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every analysis stage.')
+    parser.add_argument('--sizes', nargs='*', default=['1m'], choices=list(SYNTHETIC_SIZES),
+        help='Synthetic recording lengths to include (default: 1m).')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--save', help='Write the results to this JSON baseline file.')
+    parser.add_argument('--compare', help='Flag regressions against this JSON baseline file.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.sizes, args.repeats)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    # Startup is held to a fixed budget, baseline or not
+    regressions = [f'{key} seconds: {result["seconds"]:.4g} over the {STARTUP_BUDGET} s startup budget'
+        for key, result in results.items() if key.startswith('import:') and result['seconds'] > STARTUP_BUDGET]
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions += compareBaseline(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f'REGRESSION {message}', file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Multi-resolution min/max envelope of an audio signal, for drawing the
+amplitude graph of any time window from about as many points as the
+screen is wide. Level 0 holds the min & max of every ENVELOPE_BASE_BLOCK
+samples, and each further level combines ENVELOPE_FACTOR blocks of the
+level below. Because every block keeps its extremes, short spikes (e.g.
+clipping) stay visible at every zoom level, unlike with decimation.
+"""
+
+import numpy as np
+
+# Samples per block at the finest level (a power of two)
+ENVELOPE_BASE_BLOCK = 16
+# Blocks of one level combined into a block of the next (a power of two)
+ENVELOPE_FACTOR = 4
+# Stop adding levels once a level has no more blocks than this
+ENVELOPE_MIN_BLOCKS = 256
+# Points to aim for across a window (about screen width)
+ENVELOPE_POINTS = 2000
+
+
+def blockMinMax(values, block_size):
+    """
+    Return the min & max of every block_size values along the last axis
+    (the last block may be shorter). block_size must be a power of two.
+    """
+    n_full = values.shape[-1] // block_size
+    mins = maxs = values[..., :n_full * block_size]
+
+    # Halve the data until one value is left per block; much faster
+    # than reducing along a short axis
+    size = block_size
+    while size > 1:
+        mins = np.minimum(mins[..., 0::2], mins[..., 1::2])
+        maxs = np.maximum(maxs[..., 0::2], maxs[..., 1::2])
+        size //= 2
+
+    # Partial block at the end
+    if n_full * block_size < values.shape[-1]:
+        tail = values[..., n_full * block_size:]
+        mins = np.concatenate((mins, tail.min(axis=-1, keepdims=True)), axis=-1)
+        maxs = np.concatenate((maxs, tail.max(axis=-1, keepdims=True)), axis=-1)
+
+    return mins, maxs
+
+
+class EnvelopePyramid:
+    """
+    Per-block min & max amplitudes of a signal at several block sizes.
+    Multi-channel signals ((n_channels, n_samples)) keep a leading
+    channel axis on every level.
+    """
+
+    def __init__(self, sample_rate, block_sizes, mins, maxs, scale):
+        self.sample_rate = sample_rate
+        # Samples per block, and the block mins & maxs, of each level
+        self.block_sizes = list(block_sizes)
+        self.mins = list(mins)
+        self.maxs = list(maxs)
+        # Largest amplitude of each channel (shape (..., 1)), used to
+        # scale the envelope to -1:1
+        self.scale = scale
+
+    @classmethod
+    def build(cls, samples, sample_rate, base_block=ENVELOPE_BASE_BLOCK, factor=ENVELOPE_FACTOR):
+        """
+        Build the pyramid of a signal in one pass over the samples.
+        """
+        level_mins, level_maxs = blockMinMax(np.asarray(samples), base_block)
+        mins = [level_mins]
+        maxs = [level_maxs]
+        block_sizes = [base_block]
+
+        # Each level only reads the (much smaller) level below it
+        while mins[-1].shape[-1] > ENVELOPE_MIN_BLOCKS:
+            mins.append(blockMinMax(mins[-1], factor)[0])
+            maxs.append(blockMinMax(maxs[-1], factor)[1])
+            block_sizes.append(block_sizes[-1] * factor)
+
+        # Same scaling as the original amplitude graph (largest sample of
+        # each channel = 1)
+        scale = maxs[-1].max(axis=-1, keepdims=True)
+
+        return cls(sample_rate, block_sizes, mins, maxs, scale)
+
+    def window(self, start, stop, n_points=ENVELOPE_POINTS):
+        """
+        Return the block start times and the scaled mins & maxs covering
+        start to stop (in s), taken from the coarsest level that still
+        has at least n_points blocks in the window. The work done does not
+        depend on the length of the recording.
+        """
+        samples_per_point = (stop - start) * self.sample_rate / n_points
+
+        level = 0
+        for i, block_size in enumerate(self.block_sizes):
+            if block_size <= samples_per_point:
+                level = i
+
+        block_size = self.block_sizes[level]
+        n_blocks = self.mins[level].shape[-1]
+        first = min(max(int(start * self.sample_rate // block_size), 0), n_blocks)
+        last = min(max(int(np.ceil(stop * self.sample_rate / block_size)), first), n_blocks)
+
+        times = np.arange(first, last) * block_size / self.sample_rate
+        return times, self.mins[level][..., first:last] / self.scale, self.maxs[level][..., first:last] / self.scale
+
+    def toArrays(self):
+        """
+        Return the pyramid as json-able metadata and a dict of named
+        arrays, e.g. for saving in a SpectrogramCache entry.
+        """
+        meta = {'sample_rate': self.sample_rate, 'block_sizes': self.block_sizes,
+            'scale': np.asarray(self.scale).tolist()}
+        arrays = {}
+        for level in range(len(self.block_sizes)):
+            arrays[f'pyramid_min_{level}'] = self.mins[level]
+            arrays[f'pyramid_max_{level}'] = self.maxs[level]
+
+        return meta, arrays
+
+    @classmethod
+    def fromArrays(cls, meta, arrays):
+        """
+        Rebuild a pyramid saved with toArrays.
+        """
+        levels = range(len(meta['block_sizes']))
+        return cls(meta['sample_rate'], meta['block_sizes'],
+            [arrays[f'pyramid_min_{level}'] for level in levels],
+            [arrays[f'pyramid_max_{level}'] for level in levels],
+            np.asarray(meta['scale']))
@@ -0,0 +1,302 @@
+"""
+Columnar on-disk store of analysis features, for loading the results of
+many recordings (e.g. for model training) without re-running the
+spectral analysis. A store is a directory holding meta.json and one
+subdirectory per table:
+
+    spectrogram: time, power (one row per frame: power at every frequency)
+    peaks:       time, peak_freqs, peak_intensities (see findSpectralPeaks)
+    tracks:      the columns of peak_tracks.trackPeaks
+    resp_phases: start, end, phase ('insp' or 'exp')
+
+Tables are written in compressed .npz chunks of about FEATURE_CHUNK_ROWS
+rows, and rows can be appended at any time (e.g. while a recording is
+streamed through sound_analysis.streamAnalysis). meta.json indexes the
+time span of every chunk, so reading a time range only opens the chunks
+that overlap it. Stores can also be converted to Parquet files when
+pyarrow is installed.
+
+Usage:
+    python3 feature_store.py export filename.wav min_freq max_freq store_dir [--resp breathing_data.txt] [--stream]
+    python3 feature_store.py read store_dir table start end
+    python3 feature_store.py parquet store_dir output_dir
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from sound_analysis import analyze, streamAnalysis, BLOCK_SIZE
+from peak_tracks import trackPeaks
+from respiration_phase import doRespAnalysis
+from resp_sound_fusion import phaseIntervals
+
+# Column each table is indexed by time on
+FEATURE_TABLES = {'spectrogram': 'time', 'peaks': 'time', 'tracks': 'start', 'resp_phases': 'start'}
+# Rows buffered before a chunk is written
+FEATURE_CHUNK_ROWS = 1024
+
+
+def writeJson(filename, data):
+    """
+    Replace a json file in one step, so readers never see it half written.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_filename, filename)
+
+
+class FeatureWriter:
+    """
+    Appends rows to the tables of a store, creating it if needed. Use as
+    a context manager, or call close() to write the last chunks.
+    """
+
+    def __init__(self, path, meta=None, chunk_rows=FEATURE_CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.meta_filename = os.path.join(path, 'meta.json')
+        os.makedirs(path, exist_ok=True)
+
+        if os.path.exists(self.meta_filename):
+            with open(self.meta_filename) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'tables': {}}
+        self.meta.update(meta or {})
+        writeJson(self.meta_filename, self.meta)
+
+        # Columns appended to each table but not yet written
+        self.buffers = {}
+
+    def append(self, table, **columns):
+        """
+        Append rows to *table*. Every column must have the same number of
+        rows (first axis), and rows must be in time order.
+        """
+        if table not in FEATURE_TABLES:
+            raise Exception(f"Unknown feature table {table}.")
+        n_rows = {np.shape(values)[0] for values in columns.values()}
+        if len(n_rows) != 1:
+            raise Exception(f"Columns of {table} have different numbers of rows.")
+
+        buffer = self.buffers.setdefault(table, [])
+        buffer.append({name: np.asarray(values) for name, values in columns.items()})
+        if sum(next(iter(part.values())).shape[0] for part in buffer) >= self.chunk_rows:
+            self.writeChunks(table, partial=False)
+            writeJson(self.meta_filename, self.meta)
+
+    def flush(self, table=None):
+        """
+        Write all buffered rows of *table* (default: every table),
+        and update the time index.
+        """
+        for name in [table] if table is not None else list(self.buffers):
+            self.writeChunks(name, partial=True)
+
+        # Chunks are on disk before the index points at them
+        writeJson(self.meta_filename, self.meta)
+
+    def writeChunks(self, table, partial):
+        """
+        Write the buffered rows of *table* as chunks of chunk_rows rows,
+        adding each to the time index. Unless *partial*, rows that do not
+        fill a whole chunk stay buffered.
+        """
+        buffer = self.buffers.pop(table, [])
+        if not buffer:
+            return
+        columns = {column: np.concatenate([part[column] for part in buffer]) for column in buffer[0]}
+        n_rows = next(iter(columns.values())).shape[0]
+        n_written = n_rows if partial else n_rows - n_rows % self.chunk_rows
+
+        table_meta = self.meta['tables'].setdefault(table, {'chunks': []})
+        os.makedirs(os.path.join(self.path, table), exist_ok=True)
+        for start in range(0, n_written, self.chunk_rows):
+            chunk = {column: values[start:min(start + self.chunk_rows, n_written)] for column, values in columns.items()}
+            times = chunk[FEATURE_TABLES[table]]
+            chunk_file = f'{table}/{len(table_meta["chunks"]):06d}.npz'
+            np.savez_compressed(os.path.join(self.path, chunk_file), **chunk)
+            table_meta['chunks'].append({
+                'file': chunk_file,
+                'rows': int(times.shape[0]),
+                'start': float(np.min(times)) if times.size else None,
+                'end': float(np.max(times)) if times.size else None,
+            })
+
+        if n_written < n_rows:
+            self.buffers[table] = [{column: values[n_written:] for column, values in columns.items()}]
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FeatureStore:
+    """
+    Reads the tables of a store written by FeatureWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def chunks(self, table, start=None, stop=None):
+        """
+        Return the index entries of the chunks of *table* that
+        may hold rows between start and stop (in s).
+        """
+        chunks = self.meta['tables'].get(table, {'chunks': []})['chunks']
+        return [chunk for chunk in chunks if chunk['rows']
+            and (start is None or chunk['end'] >= start)
+            and (stop is None or chunk['start'] <= stop)]
+
+    def read(self, table, start=None, stop=None, columns=None):
+        """
+        Return the rows of *table* whose time is between start and stop
+        (in s; None for no limit) as a dict of arrays, loading only the
+        chunks that overlap the range and only the named *columns*.
+        """
+        time_column = FEATURE_TABLES[table]
+        parts = []
+        for chunk in self.chunks(table, start, stop):
+            with np.load(os.path.join(self.path, chunk['file'])) as data:
+                times = data[time_column]
+                rows = np.ones(times.shape[0], dtype=bool)
+                if start is not None:
+                    rows &= times >= start
+                if stop is not None:
+                    rows &= times <= stop
+                names = columns if columns is not None else data.files
+                parts.append({name: data[name][rows] for name in names})
+
+        if not parts:
+            return {}
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def analysisColumns(result):
+    """
+    Return the spectrogram & peak columns of an AnalysisResult,
+    with frames along the first axis.
+    """
+    spectrogram = {'time': result.times, 'power': np.moveaxis(result.spectrogram, -1, 0)}
+    peaks = {'time': result.times,
+        'peak_freqs': np.moveaxis(result.peak_freqs, -2, 0),
+        'peak_intensities': np.moveaxis(result.peak_intensities, -2, 0)}
+
+    return spectrogram, peaks
+
+
+def exportAnalysis(path, result, resp_startstop=None, resp_offset=0.0):
+    """
+    Write an AnalysisResult (and optionally the respiratory phases from
+    findRespiratoryPhase, starting resp_offset s into the recording) to
+    the store at *path*, along with the tracks of its spectral peaks.
+    """
+    meta = {
+        'filename': result.filename,
+        'sample_rate': float(result.sample_rate),
+        'audio_length': float(result.audio_length),
+        'audio_freqs': [float(freq) for freq in result.audio_freqs],
+        'frequencies': result.frequencies.tolist(),
+    }
+    spectrogram, peaks = analysisColumns(result)
+    tracks, _ = trackPeaks(result.times, result.peak_freqs, result.peak_intensities)
+
+    with FeatureWriter(path, meta) as writer:
+        writer.append('spectrogram', **spectrogram)
+        writer.append('peaks', **peaks)
+        writer.append('tracks', **tracks)
+        if resp_startstop is not None:
+            starts, ends, labels = phaseIntervals(resp_startstop)
+            writer.append('resp_phases', start=starts + resp_offset, end=ends + resp_offset, phase=labels)
+
+
+def exportStream(path, filename, audio_freqs, block_size=BLOCK_SIZE):
+    """
+    Analyse a wav file block by block (see streamAnalysis), appending
+    spectrogram frames & peaks to the store as they are computed.
+    """
+    meta = {'filename': filename, 'audio_freqs': [float(freq) for freq in audio_freqs]}
+    with FeatureWriter(path, meta) as writer:
+        for frequencies, times, spectrogram, peak_freqs, peak_intensities in streamAnalysis(filename, audio_freqs, block_size):
+            if 'frequencies' not in writer.meta:
+                writer.meta['frequencies'] = frequencies.tolist()
+            writer.append('spectrogram', time=times, power=spectrogram.T)
+            writer.append('peaks', time=times, peak_freqs=peak_freqs, peak_intensities=peak_intensities)
+
+
+def exportParquet(path, output_dir):
+    """
+    Convert every table of a store to a Parquet file in *output_dir*.
+    Needs pyarrow; multi-dimensional columns become fixed size lists.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Parquet export needs pyarrow (pip install pyarrow).")
+
+    store = FeatureStore(path)
+    os.makedirs(output_dir, exist_ok=True)
+    for table in store.meta['tables']:
+        columns = {}
+        for name, values in store.read(table).items():
+            if values.ndim > 1:
+                flat = values.reshape(values.shape[0], -1)
+                values = pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(flat.ravel()), flat.shape[1])
+            columns[name] = values
+        pyarrow.parquet.write_table(pyarrow.table(columns), os.path.join(output_dir, f'{table}.parquet'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export analysis features to a columnar store.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='Analyse a wav file into a store.')
+    export.add_argument('filename')
+    export.add_argument('min_freq', type=int)
+    export.add_argument('max_freq', type=int)
+    export.add_argument('store')
+    export.add_argument('--resp', help='Respiration data to add the phases of.')
+    export.add_argument('--resp-offset', type=float, default=0.0, help='Start of the respiration data in the recording (s).')
+    export.add_argument('--stream', action='store_true', help='Analyse block by block, appending as it goes.')
+
+    read = commands.add_parser('read', help='Print the rows of a table within a time range.')
+    read.add_argument('store')
+    read.add_argument('table', choices=list(FEATURE_TABLES))
+    read.add_argument('start', type=float)
+    read.add_argument('end', type=float)
+
+    parquet = commands.add_parser('parquet', help='Convert a store to Parquet files (needs pyarrow).')
+    parquet.add_argument('store')
+    parquet.add_argument('output_dir')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        audio_freqs = [args.min_freq, args.max_freq]
+        if args.stream:
+            exportStream(args.store, args.filename, audio_freqs)
+        else:
+            resp_startstop = None
+            if args.resp:
+                resp_startstop = doRespAnalysis(args.resp, None, return_phases=True)[-1]
+            exportAnalysis(args.store, analyze(args.filename, [0, None], audio_freqs), resp_startstop, args.resp_offset)
+    elif args.command == 'read':
+        for name, values in FeatureStore(args.store).read(args.table, args.start, args.end).items():
+            print(name, values.shape, values[:5])
+    else:
+        exportParquet(args.store, args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
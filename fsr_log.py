@@ -0,0 +1,185 @@
+"""
+Compact binary log format for force sensitive resistor (FSR) readings,
+as written by the Teensy datalogger (teensy_code/test_datalogger).
+
+A log is a 16 byte little-endian header followed by one 6 byte record
+per reading:
+
+    header: magic 'FSRB' | uint16 version | uint16 sensor id |
+            float32 nominal sample rate (Hz) | uint32 start millis
+    record: uint32 millis | uint16 FSR value
+
+Also provides a converter from the text logs ('value' or 'millis; value'
+lines) and a simulator that writes synthetic breathing data in this
+format, for testing without hardware.
+
+Usage:
+    python3 fsr_log.py convert datalog.txt datalog.bin
+    python3 fsr_log.py simulate datalog.bin 60 --realtime
+"""
+
+import os
+import sys
+import time
+import struct
+import argparse
+import numpy as np
+
+FSR_MAGIC = b'FSRB'
+FSR_VERSION = 1
+# struct layout of the header & numpy layout of each record
+FSR_HEADER = struct.Struct('<4sHHfI')
+FSR_RECORD = np.dtype([('millis', '<u4'), ('value', '<u2')])
+# Interval (ms) between readings of the datalogger, i.e. its delay()
+LOGGER_INTERVAL_MS = 20
+
+
+def isRespBinary(filename):
+    """
+    Return True if the file starts with the binary FSR log magic.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(FSR_MAGIC)) == FSR_MAGIC
+
+
+def readRespHeader(filename):
+    """
+    Return the header of a binary FSR log as a dict.
+    """
+    with open(filename, 'rb') as f:
+        magic, version, sensor_id, sample_rate, start_millis = FSR_HEADER.unpack(f.read(FSR_HEADER.size))
+
+    if magic != FSR_MAGIC:
+        raise Exception(f"{filename} is not a binary FSR log.")
+    if version != FSR_VERSION:
+        raise Exception(f"Unsupported FSR log version {version}.")
+
+    return {'sensor_id': sensor_id, 'sample_rate': sample_rate, 'start_millis': start_millis}
+
+
+def readRespBinary(filename):
+    """
+    Memory-map a binary FSR log. Returns the header dict and the
+    FSR values & millis of every record as (read-only) arrays.
+    """
+    header = readRespHeader(filename)
+
+    # Ignore a partly written final record (e.g. power lost mid-write)
+    n_records = (os.path.getsize(filename) - FSR_HEADER.size) // FSR_RECORD.itemsize
+    if n_records == 0:
+        return header, np.empty(0, np.uint16), np.empty(0, np.uint32)
+
+    records = np.memmap(filename, dtype=FSR_RECORD, mode='r', offset=FSR_HEADER.size, shape=(n_records,))
+
+    return header, records['value'], records['millis']
+
+
+class RespBinaryWriter:
+    """
+    Appends records to a new binary FSR log, the way the datalogger does.
+    """
+
+    def __init__(self, filename, sample_rate=0.0, sensor_id=0, start_millis=0):
+        self.f = open(filename, 'wb')
+        self.f.write(FSR_HEADER.pack(FSR_MAGIC, FSR_VERSION, sensor_id, sample_rate, start_millis))
+
+    def write(self, millis, vals):
+        """
+        Append the readings (arrays of equal length) to the log.
+        """
+        records = np.empty(np.shape(vals)[0], dtype=FSR_RECORD)
+        records['millis'] = millis
+        records['value'] = vals
+        self.f.write(records.tobytes())
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def convertTextLog(text_filename, binary_filename, sensor_id=0):
+    """
+    Convert a text FSR log into a binary one. Logs without millis are
+    given timestamps at the DEFAULT_RESP_HZ assumed by readRespData.
+    """
+    # Imported here because respiration_phase imports this module
+    from respiration_phase import parseRespLog, DEFAULT_RESP_HZ
+
+    vals, millis = parseRespLog(text_filename)
+    if millis is None:
+        sample_rate = DEFAULT_RESP_HZ
+        millis = np.round(np.arange(vals.shape[0]) * 1000 / sample_rate)
+    else:
+        # Estimate the nominal rate from the mean reading interval
+        sample_rate = 1000 * (vals.shape[0] - 1) / (millis[-1] - millis[0]) if vals.shape[0] > 1 else 0.0
+
+    start_millis = int(millis[0]) if vals.shape[0] else 0
+    with RespBinaryWriter(binary_filename, sample_rate, sensor_id, start_millis) as writer:
+        writer.write(millis, vals)
+
+
+def simulateLogger(filename, seconds, realtime=False, sensor_id=0, seed=None):
+    """
+    Write *seconds* of synthetic breathing readings to a binary FSR log,
+    with the interval jitter of the datalogger. With *realtime*, records
+    are written and flushed as they would be produced.
+    """
+    rng = np.random.default_rng(seed)
+    sample_rate = 1000 / LOGGER_INTERVAL_MS
+    n = int(seconds * sample_rate)
+
+    # Each reading takes the logger's delay plus a few ms of SD writing
+    millis = np.cumsum(LOGGER_INTERVAL_MS + rng.integers(0, 4, n)) + 800
+    # ~15 breaths/min, with slowly varying depth & some sensor noise
+    t = millis / 1000
+    depth = 1 + 0.3 * np.sin(2 * np.pi * t / 60)
+    vals = 200 + 150 * depth * np.sin(2 * np.pi * 0.25 * t) + rng.normal(0, 5, n)
+    vals = np.clip(np.round(vals), 0, 1023)
+
+    with RespBinaryWriter(filename, sample_rate, sensor_id, int(millis[0])) as writer:
+        if not realtime:
+            writer.write(millis, vals)
+            return
+
+        start = time.perf_counter()
+        for i in range(n):
+            writer.write(millis[i:i + 1], vals[i:i + 1])
+            writer.flush()
+            time.sleep(max(start + (millis[i] - millis[0]) / 1000 - time.perf_counter(), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Binary FSR log tools.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help='Convert a text FSR log to the binary format.')
+    convert.add_argument('text_filename')
+    convert.add_argument('binary_filename')
+    convert.add_argument('--sensor-id', type=int, default=0)
+
+    simulate = commands.add_parser('simulate', help='Write synthetic breathing data in the binary format.')
+    simulate.add_argument('filename')
+    simulate.add_argument('seconds', type=float)
+    simulate.add_argument('--realtime', action='store_true', help='Write records at the logger rate.')
+    simulate.add_argument('--sensor-id', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convertTextLog(args.text_filename, args.binary_filename, args.sensor_id)
+    else:
+        simulateLogger(args.filename, args.seconds, args.realtime, args.sensor_id)
+
+    print(readRespHeader(args.binary_filename if args.command == 'convert' else args.filename), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
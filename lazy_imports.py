@@ -0,0 +1,73 @@
+"""
+Deferred imports of the heavy dependencies (matplotlib, scipy's
+submodules), so the command line tools and `from sound_analysis import *`
+start quickly and only pay for what they use. A LazyModule stands in for
+a module and imports it on first attribute access:
+
+    signal = LazyModule('scipy.signal')
+    signal.sosfilt(sos, samples)    # scipy.signal is imported here
+
+pyplot is matplotlib.pyplot, loaded with a non-interactive backend when
+there is no display to draw on (e.g. batch runs over ssh).
+"""
+
+import os
+import sys
+import importlib
+
+# Backend used when there is no display (and MPLBACKEND is not set)
+HEADLESS_BACKEND = 'Agg'
+# Resolution of figures (matplotlib's rcParams['figure.dpi'])
+FIGURE_DPI = 100
+
+
+class LazyModule:
+    """
+    Imports module *name* on first attribute access. *loader*, if given,
+    is called instead of importlib.import_module(name) to load it.
+    """
+
+    def __init__(self, name, loader=None):
+        self._name = name
+        self._loader = loader
+        self._module = None
+
+    def __getattr__(self, attribute):
+        # Only called for attributes not set in __init__
+        if self._module is None:
+            self._module = self._loader() if self._loader else importlib.import_module(self._name)
+
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<LazyModule {self._name} ({state})>'
+
+
+def hasDisplay():
+    """
+    Return whether interactive windows can be shown.
+    """
+    if sys.platform in ('win32', 'darwin'):
+        return True
+
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def loadPyplot():
+    """
+    Import matplotlib.pyplot, choosing the headless backend if there is
+    no display and no backend was picked already, and set our defaults.
+    """
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules and 'MPLBACKEND' not in os.environ and not hasDisplay():
+        matplotlib.use(HEADLESS_BACKEND)
+
+    import matplotlib.pyplot as plt
+    # Modify default matplotlib behavior.
+    plt.rcParams['figure.dpi'] = FIGURE_DPI
+
+    return plt
+
+
+pyplot = LazyModule('matplotlib.pyplot', loadPyplot)
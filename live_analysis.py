@@ -0,0 +1,292 @@
+"""
+Real-time spectral analysis of a live stream of PCM audio (e.g. from the
+diagnosis device, or from a simulator replaying a wav file). Incoming
+samples are written to a ring buffer by a reader thread; the analysis
+loop band-pass filters them with a stateful filter and emits one
+spectrogram column and its spectral peaks per hop, along with latency
+and dropped-frame counters.
+
+Usage (replaying a recording at real-time rate into the analyzer):
+    python3 live_analysis.py simulate stridor_sounds.wav | python3 live_analysis.py analyze 44100 2 100 2000
+
+The simulator can also serve the audio over a local socket instead:
+    python3 live_analysis.py simulate stridor_sounds.wav --port 5005
+    python3 live_analysis.py analyze 44100 2 100 2000 --port 5005
+"""
+
+import sys
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+import numpy as np
+from sound_analysis import designBandpass, stft, findSpectralPeaks, NPERSEG, NOVERLAP
+# scipy is imported on first use (see lazy_imports.py)
+from lazy_imports import LazyModule
+signal = LazyModule('scipy.signal')
+wavfile = LazyModule('scipy.io.wavfile')
+
+# Number of frames read from the input stream at a time
+READ_FRAMES = 512
+# Ring buffer capacity, in seconds of audio
+RING_SECONDS = 2.0
+# Number of recent hop latencies kept for the statistics
+LATENCY_HISTORY = 1000
+
+
+class RingBuffer:
+    """
+    Fixed-size, thread-safe circular buffer of samples. When the writer
+    gets ahead of the reader by more than the capacity, the oldest unread
+    samples are overwritten and counted as dropped.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float64):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # Total number of samples ever written / read
+        self.written = 0
+        self.read_pos = 0
+        self.dropped = 0
+        # (total written, arrival time) of each recent write, for latency
+        self.arrivals = deque()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def write(self, samples):
+        """
+        Append samples, overwriting the oldest unread ones if full.
+        """
+        with self.condition:
+            # Samples that would be overwritten within this block are
+            # skipped, but still counted as written (and so dropped)
+            skipped = max(samples.shape[0] - self.capacity, 0)
+            samples = samples[skipped:]
+            self.written += skipped
+
+            start = self.written % self.capacity
+            first = min(samples.shape[0], self.capacity - start)
+            self.data[start:start + first] = samples[:first]
+            self.data[:samples.shape[0] - first] = samples[first:]
+            self.written += samples.shape[0]
+
+            # Skip the reader past anything that was overwritten
+            overrun = self.written - self.read_pos - self.capacity
+            if overrun > 0:
+                self.dropped += overrun
+                self.read_pos += overrun
+
+            self.arrivals.append((self.written, time.perf_counter()))
+            self.condition.notify()
+
+    def close(self):
+        """
+        Signal that no more samples will be written.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def read(self, n: int):
+        """
+        Block until n samples are available, then consume and return them
+        along with the arrival time of the last one. Returns None once the
+        buffer is closed and fewer than n samples are left.
+        """
+        with self.condition:
+            while self.written - self.read_pos < n:
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            start = self.read_pos % self.capacity
+            indices = (start + np.arange(n)) % self.capacity
+            samples = self.data[indices]
+            self.read_pos += n
+
+            # Drop arrival records for writes that are fully read
+            while len(self.arrivals) > 1 and self.arrivals[0][0] < self.read_pos:
+                self.arrivals.popleft()
+            arrival = self.arrivals[0][1]
+
+            return samples, arrival
+
+
+class LiveAnalyzer:
+    """
+    Stateful per-hop analysis of a live signal: band-pass filter with
+    carried state, one spectrogram column of the latest NPERSEG samples
+    every NPERSEG - NOVERLAP samples, and that column's spectral peaks.
+    """
+
+    def __init__(self, sample_rate: int, audio_freqs: list, nperseg=NPERSEG, noverlap=NOVERLAP):
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = nperseg - noverlap
+        self.sos = designBandpass(audio_freqs, sample_rate)
+        self.zi = np.zeros((self.sos.shape[0], 2))
+        # Latest nperseg filtered samples
+        self.segment = np.zeros(nperseg)
+        self.samples_seen = 0
+        self.hops = 0
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+
+    def process(self, samples, arrival=None):
+        """
+        Analyse one hop of new samples. Returns the time (in s) at the
+        center of the current segment, the spectrogram column and its
+        peak frequencies & intensities, or None while the first segment
+        is still filling.
+        """
+        filtered, self.zi = signal.sosfilt(self.sos, samples, zi=self.zi)
+        self.segment = np.roll(self.segment, -filtered.shape[0])
+        self.segment[-filtered.shape[0]:] = filtered
+        self.samples_seen += filtered.shape[0]
+
+        if self.samples_seen < self.nperseg:
+            return None
+
+        frequencies, _, column = stft(self.segment, self.sample_rate, self.nperseg, 0)
+        peak_freqs, peak_intensities = findSpectralPeaks(column.astype(np.float64), frequencies)
+        segment_time = (self.samples_seen - self.nperseg / 2) / self.sample_rate
+
+        self.hops += 1
+        if arrival is not None:
+            self.latencies.append(time.perf_counter() - arrival)
+
+        return segment_time, column[:, 0], peak_freqs[0], peak_intensities[0]
+
+    def stats(self):
+        """
+        Return the hop count and the latest, mean & max latency (in ms)
+        between the arrival of a hop's last sample and its analysis.
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'hops': self.hops,
+            'latency_ms': float(latencies[-1]) if latencies.size else 0.0,
+            'latency_mean_ms': float(latencies.mean()) if latencies.size else 0.0,
+            'latency_max_ms': float(latencies.max()) if latencies.size else 0.0,
+        }
+
+
+def readPCM(stream, ring: RingBuffer, channels: int, dtype=np.int16):
+    """
+    Read interleaved PCM frames from a binary stream into the ring
+    buffer until the stream ends. If there is more than one channel,
+    only channel 1 is used (as in sound_analysis.readFile).
+    """
+    frame_bytes = channels * np.dtype(dtype).itemsize
+    pending = b''
+
+    while True:
+        data = stream.read(READ_FRAMES * frame_bytes)
+        if not data:
+            break
+
+        # Only pass on whole frames
+        data = pending + data
+        usable = len(data) - len(data) % frame_bytes
+        pending = data[usable:]
+
+        frames = np.frombuffer(data[:usable], dtype=dtype).reshape(-1, channels)
+        ring.write(frames[:, min(1, channels - 1)])
+
+    ring.close()
+
+
+def liveAnalysis(stream, sample_rate: int, channels: int, audio_freqs: list):
+    """
+    Generator analysing a live PCM stream. A reader thread fills a ring
+    buffer while this loop yields (time, column, peak_freqs,
+    peak_intensities, stats) for every hop; stats also holds the number
+    of frames dropped because analysis fell behind.
+    """
+    ring = RingBuffer(int(RING_SECONDS * sample_rate))
+    analyzer = LiveAnalyzer(sample_rate, audio_freqs)
+
+    reader = threading.Thread(target=readPCM, args=(stream, ring, channels), daemon=True)
+    reader.start()
+
+    while True:
+        hop = ring.read(analyzer.hop)
+        if hop is None:
+            break
+
+        samples, arrival = hop
+        result = analyzer.process(samples, arrival)
+        if result is not None:
+            stats = analyzer.stats()
+            stats['dropped_frames'] = ring.dropped
+            yield result + (stats,)
+
+
+def simulateDevice(filename, stream, realtime=True):
+    """
+    Replay a wav file as raw interleaved PCM on a binary stream,
+    paced at the file's sample rate when *realtime* is True.
+    """
+    sample_rate, samples = wavfile.read(filename, mmap=True)
+    start = time.perf_counter()
+
+    for first in range(0, samples.shape[0], READ_FRAMES):
+        stream.write(np.ascontiguousarray(samples[first:first + READ_FRAMES]).tobytes())
+
+        # Sleep until the next block is "recorded"
+        if realtime:
+            due = start + (first + READ_FRAMES) / sample_rate
+            time.sleep(max(due - time.perf_counter(), 0))
+
+    stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live spectral analysis of a PCM stream.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    simulate = commands.add_parser('simulate', help='Replay a wav file as raw PCM.')
+    simulate.add_argument('filename')
+    simulate.add_argument('--port', type=int, help='Serve on this local port instead of stdout.')
+    simulate.add_argument('--fast', action='store_true', help='Do not pace the output in real time.')
+
+    analyze = commands.add_parser('analyze', help='Analyse raw 16-bit PCM from stdin or a socket.')
+    analyze.add_argument('sample_rate', type=int)
+    analyze.add_argument('channels', type=int)
+    analyze.add_argument('min_freq', type=int)
+    analyze.add_argument('max_freq', type=int)
+    analyze.add_argument('--port', type=int, help='Read from this local port instead of stdin.')
+
+    args = parser.parse_args()
+
+    if args.command == 'simulate':
+        if args.port is None:
+            simulateDevice(args.filename, sys.stdout.buffer, not args.fast)
+        else:
+            with socket.create_server(('127.0.0.1', args.port)) as server:
+                connection, _ = server.accept()
+                with connection, connection.makefile('wb') as stream:
+                    simulateDevice(args.filename, stream, not args.fast)
+        return
+
+    # Filter the minimum passed-in frequency.
+    if args.min_freq == 0:
+        raise Exception("Minimum frequency must be at least 1.")
+
+    if args.port is None:
+        stream = sys.stdin.buffer
+    else:
+        stream = socket.create_connection(('127.0.0.1', args.port)).makefile('rb')
+
+    stats = None
+    for segment_time, column, peak_freqs, peak_intensities, stats in liveAnalysis(
+            stream, args.sample_rate, args.channels, [args.min_freq, args.max_freq]):
+        peaks = ' '.join(f'{freq:8.1f}' for freq in peak_freqs[~np.isnan(peak_freqs)])
+        print(f'{segment_time:9.3f} s  {stats["latency_ms"]:6.2f} ms  {peaks}')
+
+    if stats is not None:
+        print(stats, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
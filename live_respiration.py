@@ -0,0 +1,357 @@
+"""
+Online respiration phase detection for a live stream of FSR readings
+(e.g. the Arduino's serial output, or a simulator replaying a log).
+Readings are taken one at a time: a running mean over the last
+RUNNING_WINDOW_SIZE readings is kept in O(1) per reading, and a sign
+detector on its differential reports each inspiration & expiration as
+soon as the mean has moved far enough from the turning point it began at
+(the hysteresis), with the time it began.
+
+With no hysteresis, the phases found are those of
+respiration_phase.findRespiratoryPhase (away from the ends of the log),
+reported RUNNING_WINDOW_SIZE // 2 readings after the fact, as the running
+mean of a reading needs the readings after it.
+
+Usage (replaying a log at its recorded rate into the detector):
+    python3 live_respiration.py simulate long_resp_data.txt | python3 live_respiration.py analyze
+
+The simulator can also act as a serial port (a pseudo-terminal, Unix
+only), read like the device would be. As with the device, readings sent
+before the port is opened are lost:
+    python3 live_respiration.py simulate long_resp_data.txt --pty
+    python3 live_respiration.py analyze --port /dev/pts/3
+"""
+
+import os
+import sys
+import time
+import errno
+import argparse
+from collections import deque
+import numpy as np
+from fsr_log import isRespBinary, readRespBinary
+from respiration_phase import parseRespLog, RUNNING_WINDOW_SIZE, DEFAULT_RESP_HZ
+
+# Change of the running mean (FSR units) from the turning point a run of
+# differentials began at needed to confirm a new phase; smaller
+# excursions do not end a phase
+RESP_HYSTERESIS = 2
+# Number of recent per-reading latencies kept for the statistics
+LATENCY_HISTORY = 1000
+# Name of the phase of each sign of the differential
+PHASE_NAMES = {1: 'insp', -1: 'exp'}
+
+
+class RunningMean:
+    """
+    Mean of the last *size* values, updated in O(1) per value. Means of
+    integer readings are truncated, as by uniform_filter1d.
+    """
+
+    def __init__(self, size=RUNNING_WINDOW_SIZE):
+        self.size = size
+        self.window = [0] * size
+        self.pos = 0
+        self.count = 0
+        self.total = 0
+
+    def push(self, value):
+        """
+        Add a value; returns the mean of the window, or None until
+        *size* values have been added.
+        """
+        integer = isinstance(value, (int, np.integer))
+        value = int(value) if integer else float(value)
+
+        if self.count == self.size:
+            self.total -= self.window[self.pos]
+        else:
+            self.count += 1
+        self.window[self.pos] = value
+        self.total += value
+        self.pos = (self.pos + 1) % self.size
+
+        if self.count < self.size:
+            return None
+        mean = self.total / self.size
+
+        return int(mean) if integer else mean
+
+
+class PhaseDetector:
+    """
+    Stateful respiration phase detection, one reading at a time. Phases
+    are ended and begun as in findRespiratoryPhase: a phase starts one
+    reading before the first differential of its sign, and ends one
+    reading after the last.
+    """
+
+    def __init__(self, hysteresis=RESP_HYSTERESIS, window=RUNNING_WINDOW_SIZE):
+        self.hysteresis = hysteresis
+        self.mean = RunningMean(window)
+        # The mean of a full window is that of its middle reading
+        # (as centred by uniform_filter1d), this many readings back
+        self.delay = window - 1 - window // 2
+        self.times = deque(maxlen=self.delay + 2)
+        self.previous_mean = None
+        self.n_diffs = 0
+
+        # Sign of the current phase (0 before the first) and its start
+        self.phase = 0
+        self.phase_start = None
+        # Sign of the latest non-zero differentials, when they began and
+        # the running mean at the turning point before them
+        self.run_sign = 0
+        self.run_start = None
+        self.run_extremum = None
+        # Latest differential of each sign, and the end of the phase it closes
+        self.last_index = {1: None, -1: None}
+        self.end_time = {1: None, -1: None}
+
+        self.resp_startstop = {'insp': [], 'exp': []}
+        self.readings = 0
+        self.transitions = 0
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+
+    def process(self, value, reading_time, arrival=None):
+        """
+        Take one reading (and the time, in s, it was taken). Returns a
+        list of the phases confirmed by it (usually empty), each as
+        (phase, start, confirmed): its name, the time it began and the
+        time of this reading. *arrival* (time.perf_counter) is when the
+        reading was received, for latency statistics.
+        """
+        self.times.append(reading_time)
+        mean = self.mean.push(value)
+
+        events = []
+        if mean is not None:
+            if self.previous_mean is not None:
+                events = self.differential(mean - self.previous_mean, mean)
+            self.previous_mean = mean
+
+        self.readings += 1
+        if arrival is not None:
+            self.latencies.append(time.perf_counter() - arrival)
+
+        return events
+
+    def processBlock(self, vals, time_list, arrival=None):
+        """
+        Take a block of readings; returns the phases confirmed by them.
+        """
+        events = []
+        for value, reading_time in zip(vals, time_list):
+            events.extend(self.process(value, reading_time, arrival))
+
+        return events
+
+    def differential(self, diff, mean):
+        """
+        Handle the next differential of the running mean (and the mean
+        it leads to).
+        """
+        k = self.n_diffs
+        self.n_diffs += 1
+        # Times of the readings either side of the differential
+        before, after = self.times[0], self.times[1]
+
+        # The phase of the previous differential ends at this reading
+        for sign in (1, -1):
+            if self.last_index[sign] == k - 1:
+                self.end_time[sign] = after
+
+        # Zero differentials neither extend nor end a phase
+        if diff == 0:
+            return []
+
+        sign = 1 if diff > 0 else -1
+        if sign != self.run_sign:
+            self.run_sign = sign
+            # Phases running into the start of the stream have no known start
+            self.run_start = before if k > 0 else None
+            self.run_extremum = mean - diff
+        self.last_index[sign] = k
+
+        if sign == self.phase or abs(mean - self.run_extremum) <= self.hysteresis:
+            return []
+
+        if self.phase != 0 and self.phase_start is not None:
+            self.resp_startstop[PHASE_NAMES[self.phase]].append((self.phase_start, self.end_time[self.phase]))
+        self.phase = sign
+        self.phase_start = self.run_start
+        if self.phase_start is None:
+            return []
+
+        self.transitions += 1
+        return [(PHASE_NAMES[sign], self.phase_start, self.times[-1])]
+
+    def finish(self):
+        """
+        Close the current phase at the end of the stream, if it has
+        ended. Returns every phase found, as from findRespiratoryPhase.
+        """
+        if self.phase != 0 and self.phase_start is not None and self.last_index[self.phase] < self.n_diffs - 1:
+            self.resp_startstop[PHASE_NAMES[self.phase]].append((self.phase_start, self.end_time[self.phase]))
+            self.phase_start = None
+
+        return self.phases()
+
+    def phases(self):
+        """
+        Return the phases ended so far as a dictionary with an (n, 2)
+        array of start & end times for 'insp' and 'exp'.
+        """
+        return {key: np.array(rows, dtype=float).reshape(-1, 2) for key, rows in self.resp_startstop.items()}
+
+    def stats(self):
+        """
+        Return the reading & transition counts and the latest, mean &
+        max latency (in ms) between a reading's arrival and its processing.
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'readings': self.readings,
+            'transitions': self.transitions,
+            'latency_ms': float(latencies[-1]) if latencies.size else 0.0,
+            'latency_mean_ms': float(latencies.mean()) if latencies.size else 0.0,
+            'latency_max_ms': float(latencies.max()) if latencies.size else 0.0,
+        }
+
+
+def readSerial(stream):
+    """
+    Yield (value, time, arrival) for every reading on a text or binary
+    stream of 'millis; value' or bare value lines, as sent by the
+    Arduino. Times are in s from the first reading (at DEFAULT_RESP_HZ
+    without millis). Lines that do not parse (e.g. a line cut off when
+    the port was opened) are skipped.
+    """
+    first_millis = None
+    index = 0
+    lines = iter(stream)
+
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        except OSError as error:
+            # Reading a pseudo-terminal whose writer has gone
+            if error.errno == errno.EIO:
+                return
+            raise
+        arrival = time.perf_counter()
+
+        if isinstance(line, bytes):
+            line = line.decode(errors='replace')
+        fields = line.strip().split(';')
+        try:
+            value = int(fields[-1])
+            millis = int(fields[0]) if len(fields) > 1 else None
+        except ValueError:
+            continue
+
+        if millis is not None:
+            if first_millis is None:
+                first_millis = millis
+            reading_time = (millis - first_millis) / 1000
+        else:
+            reading_time = index / DEFAULT_RESP_HZ
+        index += 1
+
+        yield value, reading_time, arrival
+
+
+def liveRespAnalysis(stream, detector=None):
+    """
+    Generator detecting respiration phases on a live stream of readings
+    with *detector* (a new PhaseDetector by default). Yields (phase,
+    start, confirmed, stats) for every phase as soon as it is confirmed.
+    """
+    detector = detector if detector is not None else PhaseDetector()
+    for value, reading_time, arrival in readSerial(stream):
+        for phase, start, confirmed in detector.process(value, reading_time, arrival):
+            yield phase, start, confirmed, detector.stats()
+
+    detector.finish()
+
+
+def simulateSerial(filename, stream, realtime=True):
+    """
+    Replay a respiration log as the Arduino's 'millis; value' lines on a
+    text stream, paced by the log's millis when *realtime* is True. Logs
+    without millis are replayed at DEFAULT_RESP_HZ.
+    """
+    if isRespBinary(filename):
+        _, vals, millis = readRespBinary(filename)
+    else:
+        vals, millis = parseRespLog(filename)
+    if millis is None:
+        millis = np.round(np.arange(vals.shape[0]) * 1000 / DEFAULT_RESP_HZ).astype(np.int64)
+
+    millis = np.asarray(millis, dtype=np.int64).tolist()
+    start = time.perf_counter()
+    for reading_millis, value in zip(millis, np.asarray(vals).tolist()):
+        # Sleep until the reading is "taken"
+        if realtime:
+            due = start + (reading_millis - millis[0]) / 1000
+            time.sleep(max(due - time.perf_counter(), 0))
+
+        stream.write(f'{reading_millis}; {value}\n')
+        stream.flush()
+
+
+def openPty():
+    """
+    Open a pseudo-terminal to act as a serial port (Unix only). Returns
+    a text stream writing to it, the path to read it from, and the fd of
+    its device end (close it once done).
+    """
+    import tty
+
+    master, device = os.openpty()
+    # No echo or line ending translation, like a raw serial port
+    tty.setraw(device)
+
+    return os.fdopen(master, 'w'), os.ttyname(device), device
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live respiration phase detection on FSR readings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    simulate = commands.add_parser('simulate', help='Replay a respiration log as serial output.')
+    simulate.add_argument('filename')
+    simulate.add_argument('--pty', action='store_true', help='Write to a pseudo-terminal instead of stdout.')
+    simulate.add_argument('--fast', action='store_true', help='Do not pace the output in real time.')
+
+    analyze = commands.add_parser('analyze', help="Detect phases in 'millis; value' lines from stdin or a port.")
+    analyze.add_argument('--port', help='Serial port (or simulator pseudo-terminal) to read instead of stdin.')
+    analyze.add_argument('--hysteresis', type=float, default=RESP_HYSTERESIS,
+        help='Change of the running mean from a turning point needed to confirm a new phase.')
+
+    args = parser.parse_args()
+
+    if args.command == 'simulate':
+        if not args.pty:
+            simulateSerial(args.filename, sys.stdout, not args.fast)
+            return
+
+        stream, path, device = openPty()
+        print(path, file=sys.stderr, flush=True)
+        with stream:
+            simulateSerial(args.filename, stream, not args.fast)
+        os.close(device)
+        return
+
+    stream = sys.stdin if args.port is None else open(args.port, 'rb')
+    detector = PhaseDetector(args.hysteresis)
+    for phase, start, confirmed, stats in liveRespAnalysis(stream, detector):
+        print(f'{start:9.3f} s  {phase:>4}  (confirmed at {confirmed:9.3f} s)  {stats["latency_ms"]:7.3f} ms')
+
+    print(detector.stats(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
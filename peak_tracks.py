@@ -0,0 +1,143 @@
+"""
+Links the per-frame spectral peaks of findSpectralPeaks into continuous
+frequency tracks (e.g. the tone of a stridor), and summarises each track
+by its birth & death times, duration, mean frequency & intensity and
+frequency slope.
+
+A peak continues a track when it and a peak of the previous frame are
+each other's nearest neighbour in frequency, no more than TRACK_MAX_JUMP
+apart. Matching is done for every pair of frames at once, and tracks are
+labelled by pointer jumping rather than walking the frames, so a full
+night of frames is handled in a few passes over arrays.
+"""
+
+import numpy as np
+
+# Largest frequency change (Hz) between frames for peaks to be linked
+TRACK_MAX_JUMP = 50.0
+# Tracks with fewer frames than this are dropped from the table
+TRACK_MIN_FRAMES = 3
+# Columns of the table returned by trackPeaks
+TRACK_COLUMNS = ('channel', 'start', 'end', 'duration', 'n_frames', 'start_freq', 'end_freq',
+    'mean_freq', 'mean_intensity', 'slope')
+
+
+def linkFrames(peak_freqs, max_jump=TRACK_MAX_JUMP):
+    """
+    Given (n_frames, n_peaks) peak frequencies (NaN where there is no
+    peak), return an array of the same shape holding, for every peak,
+    the flat index (frame * n_peaks + peak) of the peak it continues in
+    the previous frame, or -1 if it starts a new track.
+    """
+    n_frames, n_peaks = peak_freqs.shape
+    previous = np.full((n_frames, n_peaks), -1)
+    if n_frames < 2:
+        return previous
+
+    # Distance from every peak of each frame to every peak of the next
+    distance = np.abs(peak_freqs[:-1, :, None] - peak_freqs[1:, None, :])
+    distance[np.isnan(distance)] = np.inf
+
+    # Nearest peak in the next frame, and in the previous frame
+    forward = np.argmin(distance, axis=2)
+    backward = np.argmin(distance, axis=1)
+
+    # Link only mutual nearest neighbours close enough in frequency,
+    # which also makes every link one-to-one
+    frames = np.arange(n_frames - 1)[:, None]
+    peaks = np.arange(n_peaks)[None, :]
+    mutual = backward[frames, forward] == peaks
+    close = np.take_along_axis(distance, forward[:, :, None], axis=2)[:, :, 0] <= max_jump
+    linked = mutual & close
+
+    frame_index, peak_index = np.nonzero(linked)
+    previous[frame_index + 1, forward[frame_index, peak_index]] = frame_index * n_peaks + peak_index
+
+    return previous
+
+
+def trackPeaks(times, peak_freqs, peak_intensities, max_jump=TRACK_MAX_JUMP, min_frames=TRACK_MIN_FRAMES):
+    """
+    Link spectral peaks (from findSpectralPeaks; (n_frames, n_peaks) or,
+    for multi-channel results, (n_channels, n_frames, n_peaks)) into
+    tracks. Returns a columnar table (dict of TRACK_COLUMNS arrays, one
+    row per track of at least min_frames frames, by channel & start time)
+    and an array like peak_freqs giving the row of each peak's track
+    (-1 for no peak or a dropped track). Slopes are in Hz/s.
+    """
+    peak_freqs = np.asarray(peak_freqs, dtype=float)
+    peak_intensities = np.asarray(peak_intensities, dtype=float)
+    shape = peak_freqs.shape
+    n_frames, n_peaks = shape[-2:]
+    n_channels = int(np.prod(shape[:-2], dtype=int))
+
+    # Put the channels end to end, and never link across their boundaries
+    freqs = peak_freqs.reshape(n_channels * n_frames, n_peaks)
+    intensities = peak_intensities.reshape(n_channels * n_frames, n_peaks)
+    previous = linkFrames(freqs, max_jump)
+    previous[n_frames::n_frames] = -1
+    previous = previous.ravel()
+
+    # Follow the links back to the first peak of every track, doubling
+    # the distance jumped each time: log2(longest track) vectorized passes
+    root = np.where(previous >= 0, previous, np.arange(previous.size))
+    while True:
+        next_root = root[root]
+        if np.array_equal(next_root, root):
+            break
+        root = next_root
+
+    valid = ~np.isnan(freqs.ravel())
+    is_birth = valid & (previous < 0)
+    # Number tracks by their first peak, in order of time
+    track = np.cumsum(is_birth) - 1
+    track = np.where(valid, track[root], -1)
+    n_tracks = int(is_birth.sum())
+
+    point_track = track[valid]
+    point_frame = np.flatnonzero(valid) // n_peaks
+    point_time = np.tile(np.asarray(times, dtype=float), n_channels)[point_frame]
+    point_freq = freqs.ravel()[valid]
+    point_intensity = intensities.ravel()[valid]
+
+    # Points are in frame order, so a track's first point is its birth
+    # and its last point is its death
+    first_point = np.flatnonzero(is_birth[valid])
+    last_point = np.zeros(n_tracks, dtype=int)
+    np.maximum.at(last_point, point_track, np.arange(point_track.size))
+    start = point_time[first_point]
+    end = point_time[last_point]
+
+    # Per-track sums in one pass over the points
+    count = np.bincount(point_track, minlength=n_tracks)
+
+    # Least squares slope of frequency against time, with times measured
+    # from each track's start to avoid cancellation over long recordings
+    t = point_time - start[point_track]
+    sum_t = np.bincount(point_track, weights=t, minlength=n_tracks)
+    sum_f = np.bincount(point_track, weights=point_freq, minlength=n_tracks)
+    sum_tt = np.bincount(point_track, weights=t * t, minlength=n_tracks)
+    sum_tf = np.bincount(point_track, weights=t * point_freq, minlength=n_tracks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (count * sum_tf - sum_t * sum_f) / (count * sum_tt - sum_t ** 2)
+
+    table = {
+        'channel': point_frame[first_point] // n_frames,
+        'start': start,
+        'end': end,
+        'duration': end - start,
+        'n_frames': count,
+        'start_freq': point_freq[first_point],
+        'end_freq': point_freq[last_point],
+        'mean_freq': sum_f / np.maximum(count, 1),
+        'mean_intensity': np.bincount(point_track, weights=point_intensity, minlength=n_tracks) / np.maximum(count, 1),
+        'slope': slope,
+    }
+
+    # Drop short tracks and renumber the rest
+    keep = count >= min_frames
+    table = {column: values[keep] for column, values in table.items()}
+    rows = np.full(n_tracks + 1, -1)
+    rows[:-1][keep] = np.arange(int(keep.sum()))
+
+    return table, rows[track].reshape(shape)
@@ -0,0 +1,245 @@
+"""
+Opt-in per-stage profiling of the analysis pipelines. Stages of
+sound_analysis.analyze/doAnalysis and respiration_phase.doRespAnalysis
+are wrapped in profileStage(), which does nothing unless a Profiler is
+active. Inside a Profiler, each stage records its wall time, CPU time,
+bytes allocated (tracemalloc) and the sizes of the arrays it produced.
+
+Profiles are saved in the Chrome trace format (open them in
+chrome://tracing or https://ui.perfetto.dev), and the traces of many runs
+(e.g. every file of a batch) can be merged and summarised per stage.
+
+Usage:
+    with Profiler() as profiler:
+        doAnalysis('test_files/Test_Audio/piano.wav', [0, None], [100, 2000])
+    profiler.save('trace.json')
+
+    python3 profiling.py trace1.json trace2.json -o merged.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# The Profiler recording stages, if any
+_active = None
+
+
+class StageRecord:
+    """
+    Measurements of one run of a stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.arrays_info = {}
+        self.info_values = {}
+        # Highest traced memory seen while the stage ran
+        self.peak = 0
+
+    def arrays(self, **arrays):
+        """
+        Record the shape, dtype & size of arrays handled by the stage.
+        """
+        for key, array in arrays.items():
+            self.arrays_info[key] = {
+                'shape': list(getattr(array, 'shape', ())),
+                'dtype': str(getattr(array, 'dtype', type(array).__name__)),
+                'nbytes': int(getattr(array, 'nbytes', 0)),
+            }
+
+    def info(self, **values):
+        """
+        Record other (json-able) details of the stage, e.g. a file name.
+        """
+        self.info_values.update(values)
+
+
+class _NullRecord:
+    """
+    Stand-in for StageRecord when profiling is off.
+    """
+
+    def arrays(self, **arrays):
+        pass
+
+    def info(self, **values):
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+
+@contextmanager
+def _nullStage():
+    yield _NULL_RECORD
+
+
+class Profiler:
+    """
+    Records every profileStage() run while active (use as a context
+    manager). With *memory*, tracemalloc is used to count the bytes
+    allocated by each stage; this slows numpy-light code down a little.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []
+        self._stack = []
+        self._started_tracemalloc = False
+        self._previous = None
+
+    def __enter__(self):
+        global _active
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._previous = _active
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure the enclosed block as stage *name*. Yields a
+        StageRecord whose arrays() method notes array sizes.
+        """
+        record = StageRecord(name)
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # Nested stages reset the peak, so hand it up to the parent first
+            if self._stack:
+                self._stack[-1].peak = max(self._stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            start_memory = current
+
+        self._stack.append(record)
+        start_wall = time.perf_counter_ns()
+        start_cpu = time.process_time_ns()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter_ns() - start_wall
+            cpu = time.process_time_ns() - start_cpu
+            self._stack.pop()
+
+            args = dict(record.info_values, cpu_ms=cpu / 1e6)
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                record.peak = max(record.peak, peak)
+                if self._stack:
+                    self._stack[-1].peak = max(self._stack[-1].peak, record.peak)
+                args['allocated_bytes'] = current - start_memory
+                args['peak_bytes'] = record.peak - start_memory
+            if record.arrays_info:
+                args['arrays'] = record.arrays_info
+
+            # Chrome trace 'complete' event; times are in microseconds
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start_wall / 1000,
+                'dur': wall / 1000,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def toChromeTrace(self):
+        return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def save(self, filename):
+        """
+        Write the recorded stages to a Chrome trace json file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.toChromeTrace(), f)
+
+    def summary(self):
+        return summarizeTrace(self.toChromeTrace())
+
+
+def profileStage(name):
+    """
+    Context manager wrapping one stage of an analysis. Measures the
+    stage if a Profiler is active, and costs next to nothing otherwise.
+    """
+    if _active is None:
+        return _nullStage()
+
+    return _active.stage(name)
+
+
+def mergeTraces(filenames):
+    """
+    Merge Chrome trace json files (e.g. one per batch worker or run)
+    into one trace.
+    """
+    events = []
+    for filename in filenames:
+        with open(filename) as f:
+            events.extend(json.load(f)['traceEvents'])
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def summarizeTrace(trace):
+    """
+    Return the number of calls and total wall time, CPU time and
+    allocated bytes of each stage in a trace, keyed by stage name.
+    """
+    summary = {}
+    for event in trace['traceEvents']:
+        if event.get('ph') != 'X':
+            continue
+        stats = summary.setdefault(event['name'], {'calls': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0,
+            'allocated_bytes': 0, 'peak_bytes': 0})
+        stats['calls'] += 1
+        stats['wall_ms'] += event['dur'] / 1000
+        stats['cpu_ms'] += event['args'].get('cpu_ms', 0.0)
+        stats['allocated_bytes'] += event['args'].get('allocated_bytes', 0)
+        stats['peak_bytes'] = max(stats['peak_bytes'], event['args'].get('peak_bytes', 0))
+
+    return summary
+
+
+def printSummary(summary, file=sys.stdout):
+    """
+    Print a stage summary from summarizeTrace, slowest stage first.
+    """
+    width = max([len(name) for name in summary] + [len('stage')])
+    print(f'{"stage":<{width}} {"calls":>7} {"wall ms":>12} {"cpu ms":>12} {"alloc MiB":>10} {"peak MiB":>10}', file=file)
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_ms']):
+        print(f'{name:<{width}} {stats["calls"]:>7} {stats["wall_ms"]:>12.2f} {stats["cpu_ms"]:>12.2f} '
+            f'{stats["allocated_bytes"] / 2 ** 20:>10.1f} {stats["peak_bytes"] / 2 ** 20:>10.1f}', file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge and summarise profiling traces.')
+    parser.add_argument('traces', nargs='+', help='Chrome trace json files written with --profile.')
+    parser.add_argument('-o', '--output', help='Write the merged trace to this file.')
+    args = parser.parse_args()
+
+    trace = mergeTraces(args.traces)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(trace, f)
+
+    printSummary(summarizeTrace(trace))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Joins the respiration phase analysis (respiration_phase.py) with the
+spectral analysis of a sound recording (sound_analysis.py): every
+spectrogram frame is assigned to the inspiration or expiration phase it
+falls in, and spectral statistics (e.g. stridor band energy) are
+gathered per phase.
+
+Usage:
+    python3 resp_sound_fusion.py filename.wav breathing_data.txt min_freq max_freq [resp_offset]
+"""
+
+import sys
+import numpy as np
+from sound_analysis import analyze
+from respiration_phase import doRespAnalysis
+
+PHASES = ('insp', 'exp')
+
+
+def phaseIntervals(resp_startstop):
+    """
+    Merge the 'insp' and 'exp' phases from findRespiratoryPhase into
+    arrays of start times, end times and phase labels, sorted by start.
+    """
+    starts = np.concatenate([resp_startstop[phase][:, 0] for phase in PHASES])
+    ends = np.concatenate([resp_startstop[phase][:, 1] for phase in PHASES])
+    labels = np.concatenate([np.full(resp_startstop[phase].shape[0], phase) for phase in PHASES])
+
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order], labels[order]
+
+
+def assignFrames(times, starts, ends):
+    """
+    Given sorted interval start & end times, return the index of the
+    interval containing each time (-1 if none), with one binary search
+    per time. Where intervals overlap, the later starting one is used.
+    """
+    index = np.searchsorted(starts, times, side='right') - 1
+    inside = (index >= 0) & (times <= ends[np.maximum(index, 0)])
+
+    return np.where(inside, index, -1)
+
+
+def bandEnergy(frequencies, spectrogram, audio_freqs):
+    """
+    Return the spectral energy of each spectrogram frame
+    within the band audio_freqs.
+    """
+    band = (frequencies >= audio_freqs[0]) & (frequencies <= audio_freqs[1])
+    df = frequencies[1] - frequencies[0]
+
+    return spectrogram[band].sum(axis=0) * df
+
+
+def phaseSpectralStats(result, resp_startstop, resp_offset=0.0):
+    """
+    Given an AnalysisResult and the phases of a respiration recording
+    that started resp_offset seconds into the sound recording, return a
+    columnar table (dict of arrays, one row per phase) of spectral
+    statistics, and a summary comparing inspiration with expiration.
+    """
+    starts, ends, labels = phaseIntervals(resp_startstop)
+    starts = starts + resp_offset
+    ends = ends + resp_offset
+
+    frame_phase = assignFrames(result.times, starts, ends)
+    assigned = frame_phase >= 0
+    rows = frame_phase[assigned]
+    n_rows = starts.shape[0]
+
+    energy = bandEnergy(result.frequencies, result.spectrogram, result.audio_freqs)[assigned]
+    # Frequency of the most intense peak in each frame
+    top_peak = result.peak_freqs[assigned, 0]
+    has_peak = ~np.isnan(top_peak)
+
+    # Per-phase sums in one pass over the frames
+    n_frames = np.bincount(rows, minlength=n_rows)
+    energy_sum = np.bincount(rows, weights=energy, minlength=n_rows)
+    energy_max = np.zeros(n_rows)
+    np.maximum.at(energy_max, rows, energy)
+    n_peaks = np.bincount(rows[has_peak], minlength=n_rows)
+    peak_sum = np.bincount(rows[has_peak], weights=top_peak[has_peak], minlength=n_rows)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table = {
+            'phase': labels,
+            'start': starts,
+            'end': ends,
+            'n_frames': n_frames,
+            'mean_energy': energy_sum / n_frames,
+            'max_energy': energy_max,
+            'mean_peak_freq': peak_sum / n_peaks,
+        }
+
+    summary = {}
+    for phase in PHASES:
+        selected = (labels == phase) & (n_frames > 0)
+        summary[phase] = {
+            'n_phases': int(selected.sum()),
+            'n_frames': int(n_frames[selected].sum()),
+            'mean_energy': float(energy_sum[selected].sum() / max(n_frames[selected].sum(), 1)),
+            'mean_peak_freq': float(peak_sum[selected].sum() / max(n_peaks[selected].sum(), 1)),
+        }
+
+    return table, summary
+
+
+def doFusedAnalysis(wav_filename, resp_filename, audio_freqs, resp_offset=0.0):
+    """
+    Analyse a sound recording and a respiration recording together.
+    resp_offset is the time (in s) into the sound recording at which
+    the respiration recording starts. Returns the per-phase table and
+    summary from phaseSpectralStats.
+    """
+    result = analyze(wav_filename, [0, None], audio_freqs)
+    resp_startstop = doRespAnalysis(resp_filename, None, return_phases=True)[-1]
+
+    return phaseSpectralStats(result, resp_startstop, resp_offset)
+
+
+def main():
+    args = sys.argv[1:]
+
+    # If the user has provided insufficient command line arguments, raise error
+    if len(args) not in (4, 5):
+        raise Exception("Improper arguments. Must pass in: wav filename, resp filename, min_freq, max_freq, [resp_offset].")
+
+    audio_freqs = [int(args[2]), int(args[3])]
+    resp_offset = float(args[4]) if len(args) == 5 else 0.0
+
+    table, summary = doFusedAnalysis(args[0], args[1], audio_freqs, resp_offset)
+
+    for phase, stats in summary.items():
+        print(phase, stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,71 +6,149 @@ it so that it can be useful for spectrogram_func.py
 Created Jul 2022
 by Trevor Jehl
 """
+import os
 import sys
-from scipy.ndimage.filters import uniform_filter1d
 import numpy as np
-import matplotlib.pyplot as plt
+from fsr_log import isRespBinary, readRespBinary
+from time_index import TimeIndex, TimeAxis
+from profiling import Profiler, profileStage
+# Plotting & scipy are imported on first use (see lazy_imports.py)
+from lazy_imports import LazyModule, pyplot as plt
+ndimage = LazyModule('scipy.ndimage')
 
 # The size of the running average window
 RUNNING_WINDOW_SIZE = 15
+# Sampling rate assumed for logs without millis
+DEFAULT_RESP_HZ = 11.7
+# Intervals longer than this many typical intervals are gaps (lost readings)
+RESP_GAP_FACTOR = 1.5
 
 def calcHz (millis):
     """
-    Given the first two lines of the respiration data, (ex. [92010, 92096])
-    calculate the sampling frequency in Hz (samples/s).
+    Given the millis of the respiration data (ex. [92010, 92033, ...];
+    at least two), calculate the sampling frequency in Hz (samples/s)
+    over the whole log, leaving out gaps (see analyzeTimestamps).
     """
-    # Convert milliseconds to seconds
-    seconds = [num / 1000 for num in millis]
-    
-    # Calculate sampling frequency
-    hz = len(seconds) / (seconds[1] - seconds[0])
-    return hz
+    return analyzeTimestamps(millis)['hz']
 
 
-def readRespData(filename):
+def analyzeTimestamps(millis):
     """
-    Given a file path & sample start and stop
-    times (in sample #), open the file and
-    return the breathing force data.
+    Given the millis of every reading, check the timing of the log.
+    Returns a dictionary of:
+        hz: sampling frequency from the mean of the regular intervals
+        interval_ms, jitter_ms: mean & standard deviation of those intervals
+        gaps: indices of the readings followed by a gap (an interval over
+            RESP_GAP_FACTOR times the median, e.g. dropped readings)
+        gap_seconds: time lost to gaps
+        backwards: indices of the readings whose millis do not increase
+        drift: change of the interval over the log, as a fraction of it
     """
-    vals = []
-    millis = []
-    
-    # Read FSR data into vals list
-    with open(filename) as f:
-        for line in f:
-            line = line.split(' ')
-            data = int(line[-1])
-            vals.append(data)
-    
-    # If millis info is in the .txt file,
-    # read the info and calculate samples/s (Hz)
-    with open(filename) as f:
-        for line in f:
-            lst = line.split(';')
-            
-            # If there is time data, add it to list
-            if len(lst) > 1 and int(lst[0]):
-                time = float(lst[0])
-                millis.append(time)
-            
-            # Otherwise, use a predefined random freq
-            else:
-                Hz = 11.7
-                print(f"No time data found. Using Hz = {Hz}")
-                break
-
-            # If recorded two timestamps, stop reading file
-            # and calculate the sampling rate
-            if len(millis) == 2:
-                Hz = calcHz(millis)
-                break
-    
-    # Calculate real time elapsed according to Hz
-    time_list = []
-    for i in range(len(vals)): 
-        time = i / Hz
-        time_list.append(time)
+    millis = np.asarray(millis, dtype=np.int64)
+    intervals = np.diff(millis)
+    forward = intervals > 0
+    # The interval after a repeated or backwards reading catches up on
+    # it, so is neither a gap nor a regular interval
+    catch_up = np.zeros_like(forward)
+    catch_up[1:] = ~forward[:-1]
+    if not (forward & ~catch_up).any():
+        raise Exception("Timestamps must increase to estimate a sampling rate.")
+
+    typical = np.median(intervals[forward & ~catch_up])
+    gaps = (intervals > RESP_GAP_FACTOR * typical) & ~catch_up
+    regular = forward & ~gaps & ~catch_up
+    interval = intervals[regular].mean()
+
+    # Linear trend of the interval against time, over the whole log
+    drift = 0.0
+    if np.count_nonzero(regular) > 2:
+        times = millis[1:][regular] / 1000
+        if times[-1] > times[0]:
+            slope = np.polyfit(times, intervals[regular], 1)[0]
+            drift = float(slope * (times[-1] - times[0]) / interval)
+
+    return {
+        'hz': float(1000 / interval),
+        'interval_ms': float(interval),
+        'jitter_ms': float(intervals[regular].std()),
+        'gaps': np.flatnonzero(gaps),
+        'gap_seconds': float((intervals[gaps] - interval).sum() / 1000),
+        'backwards': np.flatnonzero(~forward) + 1,
+        'drift': drift,
+    }
+
+
+def resampleUniform(vals, time_list, hz):
+    """
+    Linearly interpolate readings taken at the times in time_list (in s,
+    from 0) onto a uniform grid at *hz*. Readings whose time does not
+    increase are dropped, and gaps are bridged by interpolation. Integer
+    readings stay integers (rounded). Returns the resampled values and
+    their TimeAxis.
+    """
+    vals = np.asarray(vals)
+    time_list = np.asarray(time_list, dtype=float)
+    keep = np.ones(time_list.shape[0], dtype=bool)
+    keep[1:] = time_list[1:] > np.maximum.accumulate(time_list)[:-1]
+
+    time_axis = TimeAxis(hz, int(np.floor(time_list[keep][-1] * hz + 1e-9)) + 1)
+    resampled = np.interp(time_axis.times, time_list[keep], vals[keep].astype(float))
+    if np.issubdtype(vals.dtype, np.integer):
+        resampled = np.rint(resampled).astype(vals.dtype)
+
+    return resampled, time_axis
+
+
+def parseRespLog(source):
+    """
+    Given a file path or an open (text or binary) stream of FSR
+    readings, parse the whole log in one pass. Lines are either a bare
+    FSR value or 'millis; value'. Returns an array of the FSR values and
+    an array of the millis of each reading (None if the log has none).
+    """
+    # Bare values parse as one column, 'millis; value' lines as two
+    data = np.loadtxt(source, delimiter=';', dtype=np.int64, ndmin=2)
+
+    vals = np.ascontiguousarray(data[:, -1])
+    millis = np.ascontiguousarray(data[:, 0]) if data.shape[1] > 1 else None
+
+    return vals, millis
+
+
+def readRespData(filename, resample=False):
+    """
+    Given a file path (or an open stream), read
+    the file and return the breathing force data
+    and the time (in s) of every reading. Binary
+    logs (see fsr_log.py) are memory-mapped. With
+    *resample*, logs with millis are resampled onto
+    a uniform grid at their measured rate, and the
+    times are returned as a TimeAxis.
+    """
+    if isinstance(filename, (str, os.PathLike)) and isRespBinary(os.fspath(filename)):
+        # Kept as mapped (unsigned); cast only where differences are taken
+        _, vals, millis = readRespBinary(os.fspath(filename))
+    else:
+        vals, millis = parseRespLog(filename)
+
+    # If millis info is in the .txt file, use the real time of
+    # each reading, measured from the first one
+    if millis is not None and millis.shape[0] > 0:
+        time_list = np.subtract(millis, millis[0], dtype=np.int64) / 1000
+
+        if millis.shape[0] > 1:
+            timing = analyzeTimestamps(millis)
+            if timing['gaps'].size or timing['backwards'].size:
+                print(f"{timing['gaps'].size} gaps ({timing['gap_seconds']:.3f} s) and "
+                    f"{timing['backwards'].size} out of order readings found in time data.")
+            if resample:
+                vals, time_list = resampleUniform(vals, time_list, timing['hz'])
+
+    # Otherwise, use a predefined random freq
+    else:
+        Hz = DEFAULT_RESP_HZ
+        print(f"No time data found. Using Hz = {Hz}")
+        time_list = np.arange(vals.shape[0]) / Hz
     
     return vals, time_list
 
@@ -82,7 +160,7 @@ def runningMean(vals):
     Return a list of vals of the same dimension as the
     passed-in list.
     """
-    return uniform_filter1d(vals, size = RUNNING_WINDOW_SIZE)
+    return ndimage.uniform_filter1d(vals, size = RUNNING_WINDOW_SIZE)
 
 
 def calcDifferential(vals, time_list):
@@ -91,16 +169,19 @@ def calcDifferential(vals, time_list):
     nth order differential of the data.
     """
     # Calculate the nth order discrete differential of
-    # respiration force data
+    # respiration force data (signed, for unsigned binary logs)
+    vals = np.asarray(vals)
+    if vals.dtype.kind == 'u':
+        vals = vals.astype(np.int64)
     diff = np.diff(vals, n = 1)
 
     # New time array for discrete differential array -- taking
-    # differential reduces size of array, new x vals are needed to graph
-    diff_time_vals = []
-    for i in range(1, len(vals)):
-        end = time_list[i]
-        start = time_list[i - 1]
-        diff_time_vals.append(np.mean(end - start) + start)
+    # differential reduces size of array, new x vals are needed to graph.
+    # Each difference is placed at the later of its two samples.
+    if isinstance(time_list, TimeAxis):
+        diff_time_vals = TimeAxis(time_list.sample_rate, len(time_list) - 1, time_list.start_index + 1)
+    else:
+        diff_time_vals = np.asarray(time_list, dtype=float)[1:]
 
     return diff, diff_time_vals
 
@@ -110,61 +191,41 @@ def findRespiratoryPhase(diff, diff_time_vals):
     Given the differential dataset, find the
     x vals where the y vals are > 0 [inspiration]
     or where the y vals are < 0 [expiration], return
-    a dictionary with a list of tuples that represent
-    the start and end of each phase of respiration.
+    a dictionary with an (n, 2) array for each phase whose
+    rows are the start and end of each phase of respiration.
     """
-    # A dictionary where all 'insp' data has y>0, 'exp' has y<0
+    diff = np.asarray(diff)
+    diff_time_vals = np.asarray(diff_time_vals, dtype=float)
 
-    resp_phase = {'insp' : [], 'exp' : []}
+    # A phase is a run of differentials with the same sign.
+    # Zero differentials neither extend nor end a phase.
+    nonzero = np.flatnonzero(diff)
+    signs = np.sign(diff[nonzero])
+
+    # Positions (within nonzero) where the sign flips
+    flips = np.flatnonzero(signs[1:] != signs[:-1]) + 1
+    run_starts = np.concatenate(([0], flips))[:nonzero.size]
+    run_ends = np.concatenate((flips - 1, [nonzero.size - 1]))[:nonzero.size]
+
+    start_idx = nonzero[run_starts]
+    end_idx = nonzero[run_ends]
+    run_signs = signs[run_starts]
 
-    # Each 'insp' & 'exp' list contains tuples with the start
-    # and end time (in seconds) of each respiration phase
-    resp_startstop =  {'insp' : [], 'exp' : []}
-
-    # This for loop finds all the points where the 'diff' data
-    #  is above/below the y-axis (inspiration/expiration respectively)
-    for i, num in enumerate(diff):
-        if num > 0:
-
-            if resp_phase['exp']:
-                end = resp_phase['exp'][-1]
-                start = resp_phase['exp'][0]
-                resp_startstop['exp'].append([start, end])
-                resp_phase['exp'] = []
-            
-            x_val = diff_time_vals[i]
-            resp_phase['insp'].append(x_val)
-        
-        if num < 0:
-
-            if resp_phase['insp']:
-                end = resp_phase['insp'][-1]
-                start = resp_phase['insp'][0]
-                resp_startstop['insp'].append([start, end])
-                resp_phase['insp'] = []
-    
-            x_val = diff_time_vals[i]
-            resp_phase['exp'].append(x_val)
-
-    # Checks to make sure that inspiration/expiration
-    # at the end of the file is still recorded.
-    if resp_phase['exp']:
-                end = resp_phase['exp'][-1]
-                start = resp_phase['exp'][0]
-                resp_startstop['exp'].append([start, end])
-                resp_phase['exp'] = []
-
-    if resp_phase['insp']:
-                end = resp_phase['insp'][-1]
-                start = resp_phase['insp'][0]
-                resp_startstop['insp'].append([start, end])
-                resp_phase['insp'] = []
-    
     # Without the following code, the system identifies the first
     # value above/below zero. The following code pushes the index
-    # of the start and end to the left/right respectively
-    for key, lst in resp_startstop.items():
-        resp_startstop[key] = [(diff_time_vals[diff_time_vals.index(tuple[0]) - 1], diff_time_vals[diff_time_vals.index(tuple[1]) + 1]) for tuple in lst if (diff_time_vals.index(tuple[0]) - 1 >= 0) and (diff_time_vals.index(tuple[1]) + 1 < len(diff_time_vals))]
+    # of the start and end to the left/right respectively, dropping
+    # phases that would run off either end of the data.
+    start_idx = start_idx - 1
+    end_idx = end_idx + 1
+    inside = (start_idx >= 0) & (end_idx < diff_time_vals.shape[0])
+
+    # Each 'insp' & 'exp' array contains rows with the start
+    # and end time (in seconds) of each respiration phase
+    resp_startstop = {}
+    for key, sign in (('insp', 1), ('exp', -1)):
+        selected = inside & (run_signs == sign)
+        resp_startstop[key] = np.column_stack((diff_time_vals[start_idx[selected]],
+            diff_time_vals[end_idx[selected]]))
     
     # *** Optional code for graphing vertical lines at the
     # start and end of each respiration phase (usful for visually
@@ -180,11 +241,10 @@ def findRespiratoryPhase(diff, diff_time_vals):
 
 def indexOfClosest(lst: list, num: float):
     """
-    Given lst and any number num, returns the index of the number in lst
-    that is closest to K.
+    Given a sorted lst and any number num, returns the index of the
+    number in lst that is closest to num (see TimeIndex.nearest).
     """
-    closest =  lst[min(range(len(lst)), key = lambda i: abs(lst[i] - num))]
-    return lst.index(closest)
+    return TimeIndex(lst).nearest(num)
 
 
 def graphResp(vals, running, time_list, diff, diff_time_vals, startstop):
@@ -192,8 +252,9 @@ def graphResp(vals, running, time_list, diff, diff_time_vals, startstop):
     Given all the calculated data, graph and label the data.
     """
     # Plot raw & calculated data
-    data_start = indexOfClosest(time_list, startstop[0])
-    data_end = indexOfClosest(time_list, startstop[1])
+    time_index = time_list if isinstance(time_list, TimeIndex) else TimeIndex(time_list)
+    data_start = time_index.nearest(startstop[0])
+    data_end = time_index.nearest(startstop[1])
 
     plt.subplot(2, 1, 1)
     # Graph raw data
@@ -235,22 +296,37 @@ def graphResp(vals, running, time_list, diff, diff_time_vals, startstop):
     plt.title('Respiration Phase Analysis')
     
 
-def doRespAnalysis(filename, startstop):
+def doRespAnalysis(filename, startstop, return_phases=False, resample=False):
     """ 
     Given a .txt with a list of FSR vals, and a tuple of the start
     and stop times to show on the graph, calculate all data for graphing.
     Actuall graphing is not done within this function so that this function
     can be easily called form other python scripts without automatically 
-    generating a plot.
+    generating a plot. If return_phases is True, the start/stop times of
+    each respiratory phase (see findRespiratoryPhase) are returned too.
+    With resample, readings are put on a uniform grid (see readRespData).
     """
-    vals, time_list= readRespData(filename)
-        
-    running = runningMean(vals)
-    diff, diff_time_vals = calcDifferential(running, time_list)
-
-    # Currently unused, extracts a dictionary of the start/stop 
-    # time of each respiratory phase
-    resp_startstop = findRespiratoryPhase(diff, diff_time_vals)
+    with profileStage('doRespAnalysis'):
+        with profileStage('read_resp') as stage:
+            vals, time_list= readRespData(filename, resample)
+            stage.arrays(vals=vals)
+
+        with profileStage('running_mean') as stage:
+            running = runningMean(vals)
+            stage.arrays(running=running)
+
+        with profileStage('differential') as stage:
+            diff, diff_time_vals = calcDifferential(running, time_list)
+            stage.arrays(diff=diff)
+
+        # Extracts a dictionary of the start/stop
+        # time of each respiratory phase
+        with profileStage('phases') as stage:
+            resp_startstop = findRespiratoryPhase(diff, diff_time_vals)
+            stage.arrays(**resp_startstop)
+
+    if return_phases:
+        return vals, running, time_list, diff, diff_time_vals, resp_startstop
     
     return vals, running, time_list, diff, diff_time_vals
 
@@ -258,11 +334,31 @@ def doRespAnalysis(filename, startstop):
 def main():
     # Interpret command line args
     args = sys.argv[1:]
+
+    # Optional '--profile trace.json' writes a per-stage profile
+    trace_filename = None
+    if '--profile' in args:
+        i = args.index('--profile')
+        if i + 1 >= len(args) or args[i + 1].startswith('--'):
+            raise Exception("Improper arguments. --profile must be followed by the trace filename.")
+        trace_filename = args[i + 1]
+        del args[i:i + 2]
+
+    # Optional '--resample' puts the readings on a uniform time grid
+    resample = '--resample' in args
+    if resample:
+        args.remove('--resample')
+
     filename = args[0]
     if len(args) > 0:
         startstop = (float(args[1]), float(args[2]))
     
-    vals, running, time_list, diff, diff_time_vals = doRespAnalysis(filename, startstop)
+    if trace_filename is not None:
+        with Profiler() as profiler:
+            vals, running, time_list, diff, diff_time_vals = doRespAnalysis(filename, startstop, resample=resample)
+        profiler.save(trace_filename)
+    else:
+        vals, running, time_list, diff, diff_time_vals = doRespAnalysis(filename, startstop, resample=resample)
     
     graphResp(vals, running, time_list, diff, diff_time_vals, startstop)
     plt.show()
@@ -3,21 +3,29 @@
 Date-Created: 07-11-2022
 
 Spectrogram generation script for audio sample visualization & basic feature
-extraction. Takes in a mono wav file, generates a spectrographic view of file.
+extraction. Takes in a mono or multi-channel wav file, generates a
+spectrographic view of file. Of a multi-channel file, channel 1 is analysed
+by default; readFile and analyze take *channels* to pick another channel, a
+mix of them, or every channel at once (see selectChannels), and
+AnalysisResult.channel splits a multi-channel result for plotting.
 
 TODO:
     - implement audio playing feature
-    - modify FFT implementation depending on granularity of selected timescale
 """
 
 import sys
-import matplotlib.pyplot as plt
-from scipy.io import wavfile
-from scipy import signal
-from scipy.signal import butter, sosfilt
+import functools
+import dataclasses
+from dataclasses import dataclass
 import numpy as np
-# Modify default matplotlib behavior.
-plt.rcParams['figure.dpi'] = 100
+from time_index import TimeAxis
+from envelope_pyramid import EnvelopePyramid
+from profiling import Profiler, profileStage
+# Plotting & scipy are imported on first use (see lazy_imports.py)
+from lazy_imports import LazyModule, pyplot as plt
+wavfile = LazyModule('scipy.io.wavfile')
+signal = LazyModule('scipy.signal')
+fft = LazyModule('scipy.fft')
 
 # Number of spectral peaks to be graphed
 N_SPECTRAL_PEAKS = 4
@@ -25,37 +33,124 @@ N_SPECTRAL_PEAKS = 4
 N_BUTTER_PASS = 5
 # Order of downsampling
 DOWNSAMPLE_FACTOR = 10
+# Minimum prominence for a spectral peak to be counted
+PEAK_PROMINENCE = 1000
+# Spectrogram segment length, overlap & window (see scipy documentation)
+NPERSEG = 4096
+NOVERLAP = NPERSEG // 4
+SPEC_WINDOW = 'hamming'
+# Bounds on the segment length picked by stftParameters
+MIN_NPERSEG = 256
+MAX_NPERSEG = 16384
+# Number of spectrogram frames to aim for across a view (about screen width)
+TARGET_FRAMES = 1000
+# Number of segments transformed at a time by stft
+STFT_CHUNK_FRAMES = 256
+# Threads used by scipy.fft (-1 uses every CPU)
+FFT_WORKERS = -1
+# Number of samples read at a time when streaming a file
+BLOCK_SIZE = 2 ** 16
+# Precision of the low-memory mode (see analyze)
+LOW_PRECISION_DTYPE = np.float32
+# Ways of reducing a multi-channel recording to one signal (see selectChannels)
+DOWNMIX_STRATEGIES = ('mean', 'loudest')
+# When decimating before analysis, keep the top of the band below this
+# fraction of the new Nyquist frequency (clear of the anti-alias roll-off)
+DECIMATE_BAND_FRACTION = 0.7
+# Anti-aliasing filter taps per unit of decimation factor
+DECIMATE_TAPS_PER_FACTOR = 12
+
+def resolveStartStop(audio_startstop, audio_length):
+    """
+    Fill in the ending time of audio_startstop (in place). If an ending
+    time was passed in, use that time; otherwise use the rest of the
+    audio file.
+    """
+    if not audio_startstop[1] == 'None' and not audio_startstop[1] == None:
+        audio_startstop[1] = float(audio_startstop[1])
+    else:
+        audio_startstop[1] = audio_length
+
+    return audio_startstop
+
+
+def selectChannels(samples, channels=None):
+    """
+    Given the samples of a wav file (one column per channel if it has
+    more than one), return the signal to analyse according to *channels*:
+        None: channel 1 (the second channel), as always done before
+        an int: that channel
+        'all': every channel, as a (n_channels, n_samples) view
+        'mean': the average of all channels
+        'loudest': the channel with the highest RMS amplitude
+    Mono files are returned as they are.
+    """
+    if samples.ndim == 1:
+        return samples
 
-def readFile(filename, audio_startstop):
+    # If the passed in audio file is stereo, use
+    # the audio from only one channel.
+    if channels is None:
+        return samples[0: ,1]
+    if channels == 'all':
+        # Channels first, so every function works along the last axis
+        return samples.T
+    if channels == 'mean':
+        return samples.mean(axis=1)
+    if channels == 'loudest':
+        rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64), axis=0))
+        return samples[:, np.argmax(rms)]
+
+    return samples[:, int(channels)]
+
+
+def readFile(filename, audio_startstop, channels=None):
     """
     Using a file path, opens a wav file into an array.
-    Returns the raw audio information.
+    Returns the raw audio information. See selectChannels
+    for the *channels* of multi-channel files that are kept.
     """
     # Sample_rate = the sampling rate of the wav file
     # samples = the displacement at a time
     sample_rate, samples = wavfile.read(filename)
-
-    # If the passed in audio file is stereo, use
-    # the audio from only one channel.
-    if len(np.shape(samples)) != 1:
-        samples = samples[0: ,1]
+    samples = selectChannels(samples, channels)
 
     # audio_length is the length of the audio file
-    audio_length = samples.shape[0] / sample_rate
-    
-    # If an ending time is passed in, use that time; otherwise use the rest of the audio file
-    if not audio_startstop[1] == 'None' and not audio_startstop[1] == None:
-        audio_startstop[1] = float(audio_startstop[1])
-    else:
-        audio_startstop[1] = audio_length
+    audio_length = samples.shape[-1] / sample_rate
+    audio_startstop = resolveStartStop(audio_startstop, audio_length)
 
     # time_array = array of time values for each sample (converts 
     # file from sample number in x-axis to time [s])
-    time_array = (np.arange(samples.shape[0]) / samples.shape[0]) * audio_length
+    time_array = (np.arange(samples.shape[-1]) / samples.shape[-1]) * audio_length
 
     return sample_rate, samples, audio_length, time_array, audio_startstop
 
 
+def readWindow(filename, audio_startstop, channels=None):
+    """
+    Like readFile, but memory-maps the wav file and only returns the
+    samples between audio_startstop[0] and audio_startstop[1] (in s). The
+    samples are a view into the file mapping (nothing is decoded or
+    copied, unless channels are mixed), and the time axis is a TimeAxis
+    computed on demand.
+    """
+    sample_rate, samples = wavfile.read(filename, mmap=True)
+
+    # audio_length is the length of the audio file
+    n_samples = samples.shape[0]
+    audio_length = n_samples / sample_rate
+    audio_startstop = resolveStartStop(audio_startstop, audio_length)
+
+    # Convert the window to sample numbers, clamped to the file
+    start = min(max(int(np.floor(float(audio_startstop[0]) * sample_rate)), 0), n_samples)
+    stop = min(max(int(np.ceil(audio_startstop[1] * sample_rate)), start), n_samples)
+
+    time_axis = TimeAxis(sample_rate, stop - start, start)
+
+    # Cut the window before mixing channels, so only it is read
+    return sample_rate, selectChannels(samples[start:stop], channels), audio_length, time_axis, audio_startstop
+
+
 def downSample(x, y):
     """
     Given an arbitrary set of (x,y) coordinates, downsample
@@ -70,47 +165,247 @@ def downSample(x, y):
     return downsampled_x, downsampled_y
 
 
-def butterBandpass(samples, audio_freqs, sample_rate):
+def designBandpass(audio_freqs, sample_rate):
     """
-    Given an opened wav file, implement butterworth band-pass
-    filtering according to the *lowcut* & *highcut* variables.
-    Returns filtered version of the passed in *samples* var.
+    Return the second-order sections of the butterworth band-pass
+    filter for the *lowcut* & *highcut* in audio_freqs. Designs are
+    cached, so repeated calls (e.g. one per file of a batch) are free.
     """
+    # Copied, as sosfilt needs a writable array and callers may keep it
+    return _designBandpass(float(audio_freqs[0]), float(audio_freqs[1]), float(sample_rate), N_BUTTER_PASS).copy()
+
+
+@functools.lru_cache(maxsize=64)
+def _designBandpass(low_freq: float, high_freq: float, sample_rate: float, order: int):
     # Calculate Nyquist frequency
     nyq = 0.5 * sample_rate
 
     # Calculate low & high cuts with nyquist freq
-    low = audio_freqs[0] / nyq
-    high = audio_freqs[1] / nyq
+    low = low_freq / nyq
+    high = high_freq / nyq
 
     # Calculate second-order sections representation of the IIR butter filter.
-    sos = butter(N_BUTTER_PASS, [low, high], analog=False, btype='band', output='sos')
+    sos = signal.butter(order, [low, high], analog=False, btype='band', output='sos')
 
-    # Filter data along one dimension using cascaded second-order sections.
-    y = sosfilt(sos, samples)
-    
-    return y
+    return sos
+
+
+def decimationFactor(audio_freqs, sample_rate, nperseg=NPERSEG):
+    """
+    Return the largest power of two (dividing nperseg) by which the
+    sample rate can be divided while the top of the band stays below
+    DECIMATE_BAND_FRACTION of the new Nyquist frequency.
+    """
+    factor = 1
+    while (nperseg % (factor * 2) == 0
+            and audio_freqs[1] <= DECIMATE_BAND_FRACTION * sample_rate / (factor * 2) / 2):
+        factor *= 2
+
+    return factor
 
 
-def spectralAnalysis(samples, sample_rate: int):
+@functools.lru_cache(maxsize=32)
+def antiAliasFilter(factor: int, sample_rate: float, high_freq: float):
+    """
+    Return the FIR taps used by decimateToBand: flat up to high_freq and
+    cutting off halfway to the new Nyquist frequency. Shorter than
+    resample_poly's default filter, since only the band has to be kept.
+    """
+    cutoff = (high_freq + sample_rate / factor / 2) / 2
+    taps = signal.firwin(DECIMATE_TAPS_PER_FACTOR * factor + 1, cutoff, window=('kaiser', 5.0), fs=sample_rate)
+    taps.setflags(write=False)
+
+    return taps
+
+
+def decimateToBand(samples, audio_freqs, sample_rate):
+    """
+    Lower the sample rate to just above what the band needs, with a
+    polyphase anti-aliasing filter (signal.resample_poly). Filtering and
+    the spectrogram then have far fewer samples to work through. Returns
+    the decimated samples, their sample rate and the decimation factor.
+    """
+    factor = decimationFactor(audio_freqs, sample_rate)
+    if factor == 1:
+        return samples, sample_rate, 1
+
+    taps = antiAliasFilter(factor, float(sample_rate), float(audio_freqs[1]))
+    decimated = signal.resample_poly(samples, 1, factor, axis=-1, window=taps)
+
+    return decimated, sample_rate / factor, factor
+
+
+def butterBandpass(samples, audio_freqs, sample_rate, dtype=None, out=None, zero_phase=False):
+    """
+    Given an opened wav file, implement butterworth band-pass
+    filtering according to the *lowcut* & *highcut* variables.
+    Returns filtered version of the passed in *samples* var.
+
+    With a *dtype* (e.g. LOW_PRECISION_DTYPE), the signal is filtered
+    BLOCK_SIZE samples at a time in that precision and written into
+    *out* (allocated if not given; may be *samples* itself to filter
+    in place), so no full-length float64 copy is ever made.
+
+    With *zero_phase*, the filter is run forwards and backwards
+    (signal.sosfiltfilt), so events are not delayed by the filter.
+    """
+    sos = designBandpass(audio_freqs, sample_rate)
+
+    if zero_phase:
+        if dtype is not None:
+            sos = sos.astype(dtype)
+            samples = np.asarray(samples, dtype=dtype)
+        y = signal.sosfiltfilt(sos, samples)
+        if out is not None:
+            out[...] = y
+            return out
+        return y
+
+    if dtype is None and out is None:
+        # Filter data along one dimension using cascaded second-order sections.
+        y = signal.sosfilt(sos, samples)
+
+        return y
+
+    if dtype is None:
+        dtype = out.dtype
+    if out is None:
+        out = np.empty(samples.shape, dtype=dtype)
+    sos = sos.astype(dtype)
+    # One filter state per channel
+    zi = np.zeros((sos.shape[0],) + samples.shape[:-1] + (2,), dtype=dtype)
+
+    # Carry the filter state across blocks (see streamBandpass)
+    for start in range(0, samples.shape[-1], BLOCK_SIZE):
+        block = np.asarray(samples[..., start:start + BLOCK_SIZE], dtype=dtype)
+        out[..., start:start + BLOCK_SIZE], zi = signal.sosfilt(sos, block, zi=zi)
+
+    return out
+
+
+@functools.lru_cache(maxsize=32)
+def getWindow(window, nperseg: int, dtype=np.float64):
+    """
+    Return the (read-only) window of length nperseg, computing
+    it only the first time a window/length/dtype is asked for.
+    """
+    win = signal.get_window(window, nperseg).astype(dtype)
+    win.setflags(write=False)
+    return win
+
+
+def stft(samples, sample_rate: int, nperseg=NPERSEG, noverlap=NOVERLAP, window=SPEC_WINDOW, dtype=None, nfft=None):
+    """
+    Compute the same power spectral density spectrogram as
+    signal.spectrogram (constant detrend, one-sided), but with cached
+    windows, multi-threaded scipy.fft transforms and a fixed amount of
+    scratch memory. *dtype* sets the precision of the computation; by
+    default it follows scipy (float32 for 16-bit audio, else float64).
+    Multi-channel *samples* ((n_channels, n_samples)) give a
+    (n_channels, n_freqs, n_frames) spectrogram, as with scipy.
+    """
+    if dtype is None:
+        dtype = np.result_type(samples.dtype, np.float32)
+    dtype = np.dtype(dtype)
+
+    # Segments are zero padded to nfft samples before transforming
+    if nfft is None:
+        nfft = nperseg
+
+    # As signal.spectrogram does, shorten the segments for short inputs
+    n_samples = samples.shape[-1]
+    if nperseg > n_samples:
+        nperseg = n_samples
+        noverlap = min(noverlap, nperseg - 1)
+    hop = nperseg - noverlap
+    n_frames = (n_samples - nperseg) // hop + 1 if nperseg > 0 else 0
+
+    win = getWindow(window, nperseg, dtype)
+    # Scale to a power spectral density, as signal.spectrogram does
+    scale = 1 / (sample_rate * (win * win).sum())
+
+    frequencies = fft.rfftfreq(nfft, 1 / sample_rate)
+    spectrogram = np.empty(samples.shape[:-1] + (frequencies.shape[0], n_frames), dtype=dtype)
+    times = (nperseg / 2 + np.arange(n_frames) * hop) / sample_rate
+    if n_frames == 0:
+        return frequencies, times, spectrogram
+
+    # A (..., n_frames, nperseg) view of the overlapping segments
+    segments = np.lib.stride_tricks.sliding_window_view(samples, nperseg, axis=-1)[..., ::hop, :]
+
+    # Transform a chunk of segments at a time to bound scratch memory
+    for start in range(0, n_frames, STFT_CHUNK_FRAMES):
+        chunk = np.asarray(segments[..., start:start + STFT_CHUNK_FRAMES, :], dtype=dtype)
+        chunk = chunk - chunk.mean(axis=-1, keepdims=True)
+        chunk *= win
+
+        spectrum = fft.rfft(chunk, n=nfft, axis=-1, workers=FFT_WORKERS)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        power *= scale
+        # One-sided spectrum: count the negative frequencies too
+        if nfft % 2:
+            power[..., 1:] *= 2
+        else:
+            power[..., 1:-1] *= 2
+
+        spectrogram[..., start:start + chunk.shape[-2]] = np.swapaxes(power, -1, -2)
+
+    return frequencies, times, spectrogram
+
+
+def stftParameters(n_samples: int, target_frames=TARGET_FRAMES):
+    """
+    Pick the segment length & overlap that give about target_frames
+    spectrogram frames across n_samples samples. The segment length is
+    a power of two between MIN_NPERSEG and MAX_NPERSEG, and segments
+    never leave gaps between each other.
+    """
+    hop = max(n_samples // target_frames, 1)
+
+    # Overlap segments by a quarter, as the default settings do
+    nperseg = 2 ** int(np.round(np.log2(hop * 4 / 3)))
+    nperseg = int(np.clip(nperseg, MIN_NPERSEG, MAX_NPERSEG))
+    hop = min(hop, nperseg)
+
+    return nperseg, nperseg - hop
+
+
+def spectralAnalysis(samples, sample_rate: int, nperseg=NPERSEG, noverlap=NOVERLAP, dtype=None):
     """
     After being passed in sample (amplitude information) and a sample rate (sample
     frequency), completes a FFT analysis passing the information from time domain to the
     frequency domain.
     """
-    # nperseg, noverlap, nfft can all be modified to change the spectrogram 
-    # (see scipy documentation)
-    nperseg_int = 4096
-
-    frequencies, times, spectrogram = signal.spectrogram(samples, sample_rate, 
-        nperseg = nperseg_int,
-        noverlap = nperseg_int // 4,
-        nfft = nperseg_int * 1, 
-        window = 'hamming')
+    # nperseg, noverlap can be modified to change the spectrogram 
+    # (see scipy.signal.spectrogram documentation)
+    frequencies, times, spectrogram = stft(samples, sample_rate, nperseg, noverlap, SPEC_WINDOW, dtype)
     
     return frequencies, times, spectrogram
 
 
+def adaptiveSpectralAnalysis(samples, sample_rate: int, audio_startstop: list, target_frames=TARGET_FRAMES):
+    """
+    Spectral analysis of only the audio between audio_startstop[0] and
+    audio_startstop[1] (in s), with the segment length & overlap chosen
+    by stftParameters to give about target_frames frames. Returned times
+    are relative to the start of the file.
+    """
+    n_samples = samples.shape[-1]
+    start = min(max(int(np.floor(float(audio_startstop[0]) * sample_rate)), 0), n_samples)
+    stop = min(max(int(np.ceil(float(audio_startstop[1]) * sample_rate)), start), n_samples)
+
+    nperseg, noverlap = stftParameters(stop - start, target_frames)
+
+    # Extend the view by half a segment on each side so that
+    # frames are centered all the way to its edges
+    start = max(start - nperseg // 2, 0)
+    stop = min(stop + nperseg // 2, n_samples)
+
+    frequencies, times, spectrogram = spectralAnalysis(samples[..., start:stop], sample_rate, nperseg, noverlap)
+
+    return frequencies, times + start / sample_rate, spectrogram
+
+
 def findPeaksAtTime(spectrogram, frequencies):
     """
     Assuming a slice of spectrogram has been passed in
@@ -119,7 +414,7 @@ def findPeaksAtTime(spectrogram, frequencies):
     """
     # Find peaks using scipy peak finding algorythym
     # peak-finding sensitivity can be adjusted using the prominence value
-    peaks = signal.find_peaks(spectrogram, prominence=1000)
+    peaks = signal.find_peaks(spectrogram, prominence=PEAK_PROMINENCE)
 
     # Remove the dict from peaks list
     peaks = peaks[0]
@@ -139,23 +434,185 @@ def findPeaksAtTime(spectrogram, frequencies):
     return sorted_coords
 
 
-def makeAmplitudeGraph(time_array, samples, audio_startstop, filename):
+def findSpectralPeaks(spectrogram: np.ndarray, frequencies: np.ndarray):
     """
-    Using opened .wav file, plots the sound amplitude with respect to time,
-    limiting the x-axis using passed in parameters sound_start & sound_end.
+    Batched version of findPeaksAtTime. Given the full spectrogram array,
+    return two (n_frames, N_SPECTRAL_PEAKS) arrays holding the frequency and
+    intensity of the largest peaks in every time slice, sorted by intensity.
+    Slices with fewer than N_SPECTRAL_PEAKS peaks are padded with NaN.
+    A multi-channel (n_channels, n_freqs, n_frames) spectrogram gives
+    (n_channels, n_frames, N_SPECTRAL_PEAKS) arrays, found in one pass.
+    """
+    if spectrogram.ndim > 2:
+        # Lay every channel's slices side by side and treat them as one
+        channels = spectrogram.shape[:-2]
+        stacked = np.moveaxis(spectrogram, -2, 0).reshape(spectrogram.shape[-2], -1)
+        peak_freqs, peak_intensities = findSpectralPeaks(stacked, frequencies)
+        shape = channels + (spectrogram.shape[-1], N_SPECTRAL_PEAKS)
+        return peak_freqs.reshape(shape), peak_intensities.reshape(shape)
+
+    n_freqs, n_frames = spectrogram.shape
+
+    # Stack every slice end to end, separated by +inf. A peak's prominence
+    # search stops at a strictly higher value, so each separator acts like
+    # the edge of its slice and one pass gives the per-slice results.
+    flat = np.empty((n_freqs + 1, n_frames))
+    flat[:n_freqs] = spectrogram
+    flat[n_freqs] = np.inf
+    flat = flat.ravel(order='F')
+
+    # Local maxima of the whole stack; drop the separators themselves
+    peaks = signal.find_peaks(flat)[0]
+    peaks = peaks[peaks % (n_freqs + 1) != n_freqs]
+
+    # Keep only peaks that are prominent enough
+    prominences = signal.peak_prominences(flat, peaks)[0]
+    peaks = peaks[prominences >= PEAK_PROMINENCE]
+
+    # Sort by slice, then by descending intensity. lexsort is stable, so
+    # equal intensities keep the same (low frequency first) order as sorted().
+    columns = peaks // (n_freqs + 1)
+    order = np.lexsort((-flat[peaks], columns))
+    peaks = peaks[order]
+    columns = columns[order]
+
+    # Rank of each peak within its own slice
+    column_starts = np.searchsorted(columns, columns)
+    ranks = np.arange(peaks.size) - column_starts
+    keep = ranks < N_SPECTRAL_PEAKS
+
+    peak_freqs = np.full((n_frames, N_SPECTRAL_PEAKS), np.nan)
+    peak_intensities = np.full((n_frames, N_SPECTRAL_PEAKS), np.nan)
+    peak_freqs[columns[keep], ranks[keep]] = frequencies[peaks[keep] % (n_freqs + 1)]
+    peak_intensities[columns[keep], ranks[keep]] = flat[peaks[keep]]
+
+    return peak_freqs, peak_intensities
+
+
+def readBlocks(filename, block_size=BLOCK_SIZE):
+    """
+    Memory-map a wav file and return its sample rate together with a
+    generator over consecutive blocks of at most *block_size* samples.
+    Only one block is held in memory at a time.
+    """
+    sample_rate, samples = wavfile.read(filename, mmap=True)
+    samples = selectChannels(samples)
+
+    def blocks():
+        for start in range(0, samples.shape[0], block_size):
+            # Copy the block out of the file mapping
+            yield np.array(samples[start:start + block_size])
+
+    return sample_rate, blocks()
+
+
+def streamBandpass(blocks, audio_freqs, sample_rate):
+    """
+    Streaming version of butterBandpass. Filters each block in turn,
+    carrying the filter state (zi) across block boundaries so the
+    output is identical to filtering the whole signal at once.
     """
+    sos = designBandpass(audio_freqs, sample_rate)
+    # sosfilt starts from rest, so the first block does too
+    zi = np.zeros((sos.shape[0], 2))
 
-    # floating_point converts the sound amplitude to 
-    # a range from -1:1 for graphing convenience
-    floating_point_amplitudes = samples / max([num for num in samples])
+    for block in blocks:
+        y, zi = signal.sosfilt(sos, block, zi=zi)
+        yield y
 
+
+def streamSpectrogram(blocks, sample_rate: int):
+    """
+    Streaming version of spectralAnalysis. For each incoming block, yield
+    the frequencies, times and spectrogram of every segment that has been
+    completed so far. Samples shared by overlapping segments are kept
+    between blocks, so the concatenated output matches spectralAnalysis.
+    """
+    hop = NPERSEG - NOVERLAP
+    # Samples not yet consumed by a segment, and their offset in the file
+    buffer = np.empty(0)
+    consumed = 0
+
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        if buffer.shape[0] < NPERSEG:
+            continue
+
+        # Analyse every whole segment currently in the buffer
+        n_frames = 1 + (buffer.shape[0] - NPERSEG) // hop
+        used = NPERSEG + (n_frames - 1) * hop
+        frequencies, times, spectrogram = spectralAnalysis(buffer[:used], sample_rate)
+
+        yield frequencies, times + consumed / sample_rate, spectrogram
+
+        # Keep only the samples the next segment still needs
+        buffer = buffer[n_frames * hop:]
+        consumed += n_frames * hop
+
+
+def streamAnalysis(filename: str, audio_freqs: list, block_size=BLOCK_SIZE):
+    """
+    Generator that reads, filters and analyses a wav file block by block,
+    so memory use does not grow with the length of the recording. Yields
+    the frequencies, times, spectrogram and spectral peaks (see
+    findSpectralPeaks) of each newly completed run of segments.
+    """
+    sample_rate, blocks = readBlocks(filename, block_size)
+    filtered = streamBandpass(blocks, audio_freqs, sample_rate)
+
+    for frequencies, times, spectrogram in streamSpectrogram(filtered, sample_rate):
+        peak_freqs, peak_intensities = findSpectralPeaks(spectrogram, frequencies)
+        yield frequencies, times, spectrogram, peak_freqs, peak_intensities
+
+
+def amplitudeEnvelope(time_array, samples):
+    """
+    Given the time and amplitude of every sample, return a downsampled
+    copy of the amplitudes scaled to the range -1:1 (see downSample),
+    along with the matching time values.
+    """
     # Remove some of the amplitude data for graphing (easier to graph)
-    downsampled_time, downsampled_amps = downSample(time_array, floating_point_amplitudes)
+    downsampled_time, downsampled_amps = downSample(time_array, samples)
+
+    # Convert the sound amplitude to a range from -1:1 for graphing
+    # convenience (per channel). Decimation is linear, so scaling afterwards
+    # gives the same envelope without a full-length scaled copy.
+    downsampled_amps /= np.max(samples, axis=-1, keepdims=True)
+
+    return downsampled_time, downsampled_amps
+
+
+def plotAmplitude(envelope_times, envelope, audio_startstop, filename):
+    """
+    Plot an amplitude envelope (see amplitudeEnvelope) in the top plot,
+    limiting the x-axis using passed in parameters sound_start & sound_end.
+    """
+    # Select the top plot.
+    plt.subplot(2, 1, 1)
+    # Plot & label amplitude data
+    plt.plot(envelope_times, envelope)
+    plt.ylabel('Amplitude')
+    plt.xlim(audio_startstop[0], audio_startstop[1])
+
+    # Title the graph using the file name,
+    # not the file path (if applicable)
+    filename = filename.split('/')
+    filename = filename[-1]
+    plt.title(f'{filename} Sound Analysis')
+
+
+def plotEnvelopePyramid(pyramid: EnvelopePyramid, audio_startstop, filename):
+    """
+    Plot the min/max amplitude envelope of the time between
+    audio_startstop[0] and audio_startstop[1] in the top plot, using the
+    level of the pyramid that has about one block per screen point.
+    """
+    times, mins, maxs = pyramid.window(audio_startstop[0], audio_startstop[1])
 
     # Select the top plot.
     plt.subplot(2, 1, 1)
     # Plot & label amplitude data
-    plt.plot(downsampled_time, downsampled_amps)
+    plt.fill_between(times, mins, maxs, step='post', linewidth=0.5, edgecolor='C0', facecolor='C0')
     plt.ylabel('Amplitude')
     plt.xlim(audio_startstop[0], audio_startstop[1])
 
@@ -166,6 +623,27 @@ def makeAmplitudeGraph(time_array, samples, audio_startstop, filename):
     plt.title(f'{filename} Sound Analysis')
 
 
+def makeAmplitudeGraph(time_array, samples, audio_startstop, filename):
+    """
+    Using opened .wav file, plots the sound amplitude with respect to time,
+    limiting the x-axis using passed in parameters sound_start & sound_end.
+    """
+    downsampled_time, downsampled_amps = amplitudeEnvelope(time_array, samples)
+    plotAmplitude(downsampled_time, downsampled_amps, audio_startstop, filename)
+
+
+def decibels(spectrogram: np.ndarray, out=None):
+    """
+    Return 10*log10(spectrogram), in the spectrogram's own precision
+    and with a single output array (*out*, which may be the spectrogram
+    itself, or a new array).
+    """
+    out = np.log10(spectrogram, out=out)
+    out *= 10
+
+    return out
+
+
 def makeSpectrogram(times: np.ndarray, frequencies, spectrogram: np.ndarray, audio_startstop: list, audio_freqs):
     """
     After spectral analysis is performed, this function takes that 
@@ -175,7 +653,7 @@ def makeSpectrogram(times: np.ndarray, frequencies, spectrogram: np.ndarray, aud
     plt.subplot(2,1,2)
     # Create spectrogram
     
-    spectrogram = 10*np.log10(spectrogram) #account for dB scaling
+    spectrogram = decibels(spectrogram) #account for dB scaling
     plt.pcolormesh(times, frequencies, spectrogram, cmap='magma', shading='auto')
 
     # Stylize graphs
@@ -192,46 +670,156 @@ def graphSpectralPeaks(spectrogram: np.ndarray, frequencies: np.ndarray, audio_l
     Given the full spectrogram array, plot N_SPECTRAL_PEAKS points vertically
     along each horizontal 'slice' of the spectrogram.
     """
+    # Find the spectral peaks of every slice at once
+    peak_freqs, _ = findSpectralPeaks(spectrogram, frequencies)
+
+    # Spread the slices evenly over the length of the audio
+    times = np.arange(spectrogram.shape[1]) * (audio_length / spectrogram.shape[1])
+    plotSpectralPeaks(times, peak_freqs)
+
+
+def plotSpectralPeaks(times: np.ndarray, peak_freqs: np.ndarray):
+    """
+    Given the time of each spectrogram slice and the (n_frames,
+    N_SPECTRAL_PEAKS) peak frequencies from findSpectralPeaks,
+    plot the peaks over the spectrogram in one call.
+    """
     # Selet the second plot
     plt.subplot(2,1,2)
 
-    for i in range(spectrogram.shape[1]):
-        # For each iteration, consider a vertical slice of the spectrogram
-        working_spectrogram = spectrogram[:,i]
-        # For each slice, find the spectral peaks
-        sorted_coords = findPeaksAtTime(working_spectrogram, frequencies)
-
-        # Convert the given xy axes (frequency/intensity) to the time/frequency axes (i.e. for spectrogram)
-        y_coords = [tup[0] for tup in sorted_coords]
-        x_coords = [i * (audio_length / spectrogram.shape[1]) for _ in range(len(y_coords))]
+    # Convert the given xy axes (frequency/intensity) to the time/frequency axes (i.e. for spectrogram)
+    x_coords = np.repeat(times, peak_freqs.shape[1])
+    y_coords = peak_freqs.ravel()
 
-        plt.plot(x_coords, y_coords,
-            marker="o", 
-            markersize=3,
-            markeredgecolor="green",
-            markerfacecolor="green",
-            linestyle='None',)
+    plt.scatter(x_coords, y_coords, s=9, color="green")
 
 
-def doAnalysis(filename: str, audio_startstop: list, audio_freqs: list):
+@dataclass
+class AnalysisResult:
     """
-    Given a file path, the starting and ending 
-    times (in s) to graph of the sound file, and the minimum and maximum
-    frequencies to graph, return a plot with audio amplitude & spectrogram
-    graphed.
+    Everything computed by analyze(), with no plotting state attached.
+    """
+    filename: str
+    sample_rate: int
+    audio_length: float
+    audio_startstop: list
+    audio_freqs: list
+    # Spectrogram of the filtered audio (see spectralAnalysis)
+    frequencies: np.ndarray
+    times: np.ndarray
+    spectrogram: np.ndarray
+    # (n_frames, N_SPECTRAL_PEAKS) arrays (see findSpectralPeaks)
+    peak_freqs: np.ndarray
+    peak_intensities: np.ndarray
+    # Downsampled amplitude of the filtered audio (see amplitudeEnvelope)
+    envelope_times: np.ndarray
+    envelope: np.ndarray
+    # Min/max envelope of the filtered audio at several resolutions
+    pyramid: EnvelopePyramid = None
+
+    def channel(self, index: int):
+        """
+        Return the AnalysisResult of one channel of a multi-channel
+        analysis (see analyze), e.g. for renderAnalysis.
+        """
+        pyramid = self.pyramid
+        if pyramid is not None:
+            pyramid = EnvelopePyramid(pyramid.sample_rate, pyramid.block_sizes,
+                [mins[index] for mins in pyramid.mins], [maxs[index] for maxs in pyramid.maxs], pyramid.scale[index])
+
+        return dataclasses.replace(self,
+            spectrogram=self.spectrogram[index],
+            peak_freqs=self.peak_freqs[index],
+            peak_intensities=self.peak_intensities[index],
+            envelope=self.envelope[index],
+            pyramid=pyramid)
+
+
+def analyze(filename: str, audio_startstop: list, audio_freqs: list, adaptive=False, dtype=None, channels=None,
+        decimate=False, zero_phase=False):
     """
-    sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, audio_startstop)
+    Headless version of doAnalysis. Reads, filters and analyses the
+    file and returns an AnalysisResult without importing matplotlib
+    (pyplot is only loaded on first use, see lazy_imports.py), so it
+    can be used from scripts and machines that never make a graph. If
+    *adaptive* is True, the spectrogram only covers audio_startstop and
+    is resolved to suit its length (see adaptiveSpectralAnalysis).
+    A *dtype* (e.g. LOW_PRECISION_DTYPE) sets the precision of the
+    filtered signal and spectrogram, roughly halving memory use.
+    With channels='all' (see selectChannels), every channel of the file
+    is analysed at once and each array gains a leading channel axis.
+    With *decimate*, the audio is first brought down to the lowest
+    sample rate that holds the band (see decimateToBand); segments are
+    shortened to match, so frame times and frequency resolution stay
+    the same. *zero_phase* filters without phase delay (see butterBandpass).
+    """
+    with profileStage('read') as stage:
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, audio_startstop, channels)
+        stage.arrays(samples=samples)
+
+    # Rate the rest of the analysis works at
+    analysis_rate = sample_rate
+    factor = 1
+    if decimate:
+        with profileStage('decimate') as stage:
+            samples, analysis_rate, factor = decimateToBand(samples, audio_freqs, sample_rate)
+            time_array = np.arange(samples.shape[-1]) / analysis_rate
+            stage.arrays(samples=samples)
 
     # Pass commands into butterworth band pass filter
-    samples = butterBandpass(samples, audio_freqs, sample_rate)
+    with profileStage('filter') as stage:
+        samples = butterBandpass(samples, audio_freqs, analysis_rate, dtype, zero_phase=zero_phase)
+        stage.arrays(samples=samples)
 
     # Do spectral analysis on wav file
-    frequencies, times, spectrogram = spectralAnalysis(samples, sample_rate)
+    with profileStage('spectrogram') as stage:
+        if adaptive:
+            frequencies, times, spectrogram = adaptiveSpectralAnalysis(samples, analysis_rate, audio_startstop)
+        else:
+            frequencies, times, spectrogram = spectralAnalysis(samples, analysis_rate, NPERSEG // factor, NOVERLAP // factor)
+        stage.arrays(spectrogram=spectrogram)
+
+    with profileStage('peaks') as stage:
+        peak_freqs, peak_intensities = findSpectralPeaks(spectrogram, frequencies)
+        stage.arrays(peak_freqs=peak_freqs, peak_intensities=peak_intensities)
+
+    with profileStage('envelope') as stage:
+        envelope_times, envelope = amplitudeEnvelope(time_array, samples)
+        pyramid = EnvelopePyramid.build(samples, analysis_rate)
+        stage.arrays(envelope=envelope, pyramid_base=pyramid.mins[0])
+
+    return AnalysisResult(filename, sample_rate, audio_length, audio_startstop, audio_freqs,
+        frequencies, times, spectrogram, peak_freqs, peak_intensities, envelope_times, envelope, pyramid)
+
 
-    # Make graphs.
-    makeAmplitudeGraph(time_array, samples, audio_startstop, filename)
-    makeSpectrogram(times, frequencies, spectrogram, audio_startstop, audio_freqs)
-    graphSpectralPeaks(spectrogram, frequencies, audio_length)
+def renderAnalysis(result: AnalysisResult):
+    """
+    Plot the amplitude graph, spectrogram and spectral peaks
+    of a single-channel AnalysisResult (see AnalysisResult.channel).
+    """
+    with profileStage('plot_amplitude'):
+        if result.pyramid is not None:
+            plotEnvelopePyramid(result.pyramid, result.audio_startstop, result.filename)
+        else:
+            plotAmplitude(result.envelope_times, result.envelope, result.audio_startstop, result.filename)
+    with profileStage('plot_spectrogram'):
+        makeSpectrogram(result.times, result.frequencies, result.spectrogram, result.audio_startstop, result.audio_freqs)
+    with profileStage('plot_peaks'):
+        plotSpectralPeaks(result.times, result.peak_freqs)
+
+
+def doAnalysis(filename: str, audio_startstop: list, audio_freqs: list, dtype=None):
+    """
+    Given a file path, the starting and ending 
+    times (in s) to graph of the sound file, and the minimum and maximum
+    frequencies to graph, return a plot with audio amplitude & spectrogram
+    graphed. *dtype* is passed on to analyze.
+    """
+    with profileStage('doAnalysis'):
+        result = analyze(filename, audio_startstop, audio_freqs, dtype=dtype)
+
+        # Make graphs.
+        renderAnalysis(result)
     
     return plt
     
@@ -239,6 +827,15 @@ def doAnalysis(filename: str, audio_startstop: list, audio_freqs: list):
 def main():
     args = sys.argv[1:]
 
+    # Optional '--profile trace.json' writes a per-stage profile
+    trace_filename = None
+    if '--profile' in args:
+        i = args.index('--profile')
+        if i + 1 >= len(args) or args[i + 1].startswith('--'):
+            raise Exception("Improper arguments. --profile must be followed by the trace filename.")
+        trace_filename = args[i + 1]
+        del args[i:i + 2]
+
     # If the user has provided insufficient command line arguments, raise error
     if len(args) != 5:
         raise Exception("Improper arguments. Must pass in 5 parameters: filename, sound_start, sound_end, min_freq, max_freq.")
@@ -253,7 +850,12 @@ def main():
     # Frequencies can only be int values
     audio_freqs = [int(args[3]), int(args[4])]
 
-    doAnalysis(filename, audio_startstop, audio_freqs)
+    if trace_filename is not None:
+        with Profiler() as profiler:
+            doAnalysis(filename, audio_startstop, audio_freqs)
+        profiler.save(trace_filename)
+    else:
+        doAnalysis(filename, audio_startstop, audio_freqs)
     plt.show()
 
 
@@ -0,0 +1,180 @@
+"""
+On-disk cache of analysis results (see sound_analysis.analyze), so that
+re-opening a recording with a different view window does not re-run the
+band-pass filter and spectral analysis.
+
+Entries are keyed by a hash of the file contents together with every
+setting that changes the result (filter band & order, spectrogram
+segmenting, peak finding). Each entry is a directory of .npy files (the
+spectrogram, peak tables and amplitude envelope pyramid) that are
+memory-mapped when loaded. When the cache grows past its size limit
+the least recently used entries are deleted.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import functools
+import tempfile
+import numpy as np
+import sound_analysis
+import envelope_pyramid
+from sound_analysis import AnalysisResult, analyze, resolveStartStop
+from envelope_pyramid import EnvelopePyramid
+
+# Default cache location & size limit (in bytes)
+CACHE_DIR = os.environ.get('VCD_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vcd_spectrograms'))
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Arrays of an AnalysisResult stored in each cache entry
+CACHED_ARRAYS = ('frequencies', 'times', 'spectrogram', 'peak_freqs', 'peak_intensities',
+    'envelope_times', 'envelope')
+# Size of the chunks read when hashing a file
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def fileHash(filename):
+    """
+    Return the sha256 hex digest of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _fileHash(path: str, size: int, mtime_ns: int):
+    # Shared by every SpectrogramCache, so repeat cachedAnalyze calls on
+    # an unchanged file do not read it again
+    return fileHash(path)
+
+
+class SpectrogramCache:
+    """
+    A size-bounded, least recently used cache of analysis results
+    stored under *cache_dir*.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, filename, audio_freqs):
+        """
+        Return the cache key of *filename* analysed with the band
+        audio_freqs and the current sound_analysis settings.
+        """
+        # Hashes are reused until the file's size or mtime changes
+        stat = os.stat(filename)
+        file_hash = _fileHash(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+        # Read the settings at call time so changes to them are picked up
+        settings = {
+            'file': file_hash,
+            'audio_freqs': [float(freq) for freq in audio_freqs],
+            'n_butter_pass': sound_analysis.N_BUTTER_PASS,
+            'nperseg': sound_analysis.NPERSEG,
+            'noverlap': sound_analysis.NOVERLAP,
+            'window': sound_analysis.SPEC_WINDOW,
+            'n_spectral_peaks': sound_analysis.N_SPECTRAL_PEAKS,
+            'peak_prominence': sound_analysis.PEAK_PROMINENCE,
+            'downsample_factor': sound_analysis.DOWNSAMPLE_FACTOR,
+            'envelope_base_block': envelope_pyramid.ENVELOPE_BASE_BLOCK,
+            'envelope_factor': envelope_pyramid.ENVELOPE_FACTOR,
+        }
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Return the metadata and memory-mapped arrays (by name) stored
+        under *key*, or None if there is no such entry.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            arrays = {name[:-len('.npy')]: np.load(os.path.join(entry, name), mmap_mode='r')
+                for name in os.listdir(entry) if name.endswith('.npy')}
+        except FileNotFoundError:
+            return None
+
+        # Mark the entry as recently used
+        os.utime(entry)
+        return meta, arrays
+
+    def store(self, key, meta, arrays):
+        """
+        Save *meta* (a json-able dict) and the named *arrays* under
+        *key*, then evict old entries if the cache is too large.
+        """
+        # Write into a temporary directory and rename it into place, so
+        # other processes never see a partly written entry
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+
+        try:
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache
+        fits within max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry))
+            entries.append((os.stat(entry).st_mtime, size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def cachedAnalyze(filename: str, audio_startstop: list, audio_freqs: list, cache=None):
+    """
+    Same as sound_analysis.analyze, but the result is loaded from *cache*
+    (a SpectrogramCache, by default one at CACHE_DIR) when the file has
+    already been analysed with the same band and settings.
+    """
+    if cache is None:
+        cache = SpectrogramCache()
+
+    key = cache.key(filename, audio_freqs)
+    entry = cache.load(key)
+
+    if entry is None:
+        # Always analyse the whole file, since the view window only
+        # changes audio_startstop
+        result = analyze(filename, [0, None], audio_freqs)
+        pyramid_meta, pyramid_arrays = result.pyramid.toArrays()
+        meta = {'sample_rate': int(result.sample_rate), 'audio_length': result.audio_length, 'pyramid': pyramid_meta}
+        arrays = {name: getattr(result, name) for name in CACHED_ARRAYS}
+        cache.store(key, meta, {**arrays, **pyramid_arrays})
+
+        result.audio_startstop = resolveStartStop(audio_startstop, result.audio_length)
+        return result
+
+    meta, arrays = entry
+    audio_startstop = resolveStartStop(audio_startstop, meta['audio_length'])
+    pyramid = EnvelopePyramid.fromArrays(meta['pyramid'], arrays)
+
+    return AnalysisResult(filename, meta['sample_rate'], meta['audio_length'], audio_startstop,
+        audio_freqs, *[arrays[name] for name in CACHED_ARRAYS], pyramid)
@@ -4,6 +4,10 @@
   The circuit:
   FSR voltage dividor w/ potentiometer.
 
+  Readings are logged to datalog.bin in the binary format described in
+  fsr_log.py: a 16 byte header followed by a packed
+  (uint32 millis, uint16 value) record per reading.
+
   Created 26 Jul 2022
   by Trevor Jehl
 */
@@ -14,6 +18,30 @@
 
 const int chipSelect = BUILTIN_SDCARD;
 
+// Delay between readings (ms)
+const int LOG_INTERVAL_MS = 20;
+// Records written between flushes of the log to the SD card
+const int FLUSH_EVERY = 50;
+// Set to true to also print every reading to the serial port
+const bool SERIAL_ECHO = false;
+
+// Binary log layout (little-endian, matches fsr_log.py)
+struct __attribute__((packed)) LogHeader {
+  char magic[4];
+  uint16_t version;
+  uint16_t sensorId;
+  float sampleRate;
+  uint32_t startMillis;
+};
+
+struct __attribute__((packed)) LogRecord {
+  uint32_t millis;
+  uint16_t value;
+};
+
+File dataFile;
+int recordsSinceFlush = 0;
+
 void initializeCard() {
   Serial.print("Initializing SD card...");
   // see if the card is present and can be initialized:
@@ -25,14 +53,31 @@ void initializeCard() {
   }
 
   // Delete the old datalog.
-  while (!SD.remove("datalog.txt")) {
-    Serial.println("Failed to delete file.");
-    delay(100);
+  if (SD.exists("datalog.bin")) {
+    while (!SD.remove("datalog.bin")) {
+      Serial.println("Failed to delete file.");
+      delay(100);
+    }
   }
 
   Serial.println("Card initialized.");
 }
 
+void openLog() {
+  // Keep the log open; opening & closing it for every reading is slow
+  dataFile = SD.open("datalog.bin", FILE_WRITE);
+  if (!dataFile) {
+    Serial.println("Error opening datalog.bin");
+    while (1) {
+      // Nowhere to log to, so don't do anything more - stay stuck here
+    }
+  }
+
+  LogHeader header = {{'F', 'S', 'R', 'B'}, 1, 0, 1000.0 / LOG_INTERVAL_MS, millis()};
+  dataFile.write((const uint8_t *)&header, sizeof(header));
+  dataFile.flush();
+}
+
 void setup() {
   //UNCOMMENT THESE TWO LINES FOR TEENSY AUDIO BOARD:
   SPI.setMOSI(7);  // Audio shield has MOSI on pin 7
@@ -45,54 +90,43 @@ void setup() {
   }
   // Initialize SD card.
   initializeCard();
+  openLog();
 }
 
 
-String readFSR() {
-  // read three sensors and append to the string:
+uint16_t readFSR() {
+  // read the sensor
   int FSRPin = A3;
-  int sensor = analogRead(FSRPin);
-  
-  // Return the string of the sensor reading for
-  // datalog writing convenience
-  return String(sensor);
+  return analogRead(FSRPin);
 }
 
 
-void writeDataSD(String dataString) {
-  // open the file
-  File dataFile = SD.open("datalog.txt", FILE_WRITE);
+void writeDataSD(LogRecord record) {
+  dataFile.write((const uint8_t *)&record, sizeof(record));
 
-  // if the file is available, write to it:
-  if (dataFile) {
-    
-    dataFile.println(dataString);
-    dataFile.close();
-    // print to the serial port too:
-    Serial.println(dataString);
+  // Flush in batches; a flush per reading costs a full SD block write
+  if (++recordsSinceFlush >= FLUSH_EVERY) {
+    dataFile.flush();
+    recordsSinceFlush = 0;
   }
-  else {
-    // if the file isn't open, pop up an error:
-    Serial.println("Error opening datalog.txt");
+
+  // print to the serial port too:
+  if (SERIAL_ECHO) {
+    Serial.print(record.millis);
+    Serial.print("; ");
+    Serial.println(record.value);
   }
-  
 }
 
 
 void loop() {
-  //  Serial.println(hour());
-  // make a string for assembling the data to log:
-  String dataString = "";
-  // Add 'millis;' to the start of the datafile, 
+  // Record the time of the reading alongside it,
   // useful for determining sample rate
-  dataString += String(millis());
-  dataString += String("; ");
-  
-  // Read the value of the FSR, add it to data to be logged
-  String FSR_Reading = readFSR();
-  dataString += String(FSR_Reading);
-
-  // Write dataString to a new line in txt file
-  writeDataSD(dataString);
-  delay(20); // run at a reasonable not-too-fast speed
+  LogRecord record;
+  record.millis = millis();
+  record.value = readFSR();
+
+  // Write the record to the binary log
+  writeDataSD(record);
+  delay(LOG_INTERVAL_MS); // run at a reasonable not-too-fast speed
 }
\ No newline at end of file
@@ -1,10 +1,37 @@
 """
 Unit tests for spectrogram_func.py.
 """
+import io
+import os
+import sys
+import json
+import shutil
+import pathlib
+import tempfile
+import subprocess
 import unittest
 import numpy as np
 from sound_analysis import *
 from respiration_phase import *
+from batch_analysis import findWavFiles, analyzeFile, outputNames, runBatch
+import spectrogram_cache
+from spectrogram_cache import SpectrogramCache, cachedAnalyze
+from live_analysis import RingBuffer, LiveAnalyzer
+from live_respiration import PhaseDetector, RunningMean, liveRespAnalysis, simulateSerial
+from fsr_log import convertTextLog, readRespBinary, simulateLogger
+from resp_sound_fusion import assignFrames, doFusedAnalysis
+from time_index import TimeIndex, TimeAxis
+from envelope_pyramid import EnvelopePyramid, ENVELOPE_POINTS
+from peak_tracks import trackPeaks
+from feature_store import FeatureWriter, FeatureStore, exportAnalysis, exportStream
+from analysis_session import AnalysisSession
+from profiling import Profiler, profileStage, summarizeTrace
+from benchmarks import writeSyntheticWav, soundCases, measure, compareBaseline
+from benchmarks import measureStartup, STARTUP_MODULES, STARTUP_BUDGET
+
+# Location of the bundled test recordings, independent of the working directory
+TEST_AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_files', 'Test_Audio')
+TEST_BREATHING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test_files', 'Test_Breathing_Data')
 
 class testSpectrogram(unittest.TestCase):
 
@@ -47,11 +74,611 @@ class testSpectrogram(unittest.TestCase):
         self.assertEqual(type(sorted_coords[0]), tuple)
         self.assertTrue(sorted_coords[0][0] == 1173.5595703125)
         self.assertAlmostEqual(sorted_coords[0][1], 19931.395, 3)
+
+
+    def test_find_spectral_peaks(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+        frequencies, times, spectrogram = spectralAnalysis(samples, sample_rate)
+
+        peak_freqs, peak_intensities = findSpectralPeaks(spectrogram, frequencies)
+        self.assertEqual(peak_freqs.shape, (spectrogram.shape[1], N_SPECTRAL_PEAKS))
+
+        # Every slice must match the single-slice peak finder, NaN padded
+        for i in range(spectrogram.shape[1]):
+            sorted_coords = findPeaksAtTime(spectrogram[:, i], frequencies)
+            n = len(sorted_coords)
+            self.assertTrue(np.all(np.isnan(peak_freqs[i, n:])))
+            self.assertEqual(list(peak_freqs[i, :n]), [tup[0] for tup in sorted_coords])
+            self.assertEqual(list(peak_intensities[i, :n]), [tup[1] for tup in sorted_coords])
+
+
+    def test_stream_analysis(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        audio_freqs = [100, 2000]
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+        samples = butterBandpass(samples, audio_freqs, sample_rate)
+        frequencies, times, spectrogram = spectralAnalysis(samples, sample_rate)
+
+        # Blocks smaller than a segment exercise the overlap stitching
+        blocks = list(streamAnalysis(filename, audio_freqs, block_size=1000))
+        stream_times = np.concatenate([block[1] for block in blocks])
+        stream_spectrogram = np.hstack([block[2] for block in blocks])
+
+        self.assertTrue(np.allclose(stream_times, times))
+        self.assertTrue(np.allclose(stream_spectrogram, spectrogram))
+
+
+    def test_read_window(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        sample_rate, samples, audio_length, time_array, _ = readFile(filename, [0, None])
+        sample_rate, window, window_length, time_axis, audio_startstop = readWindow(filename, [1, '1.5'])
+
+        # The window is a view of the requested samples only
+        self.assertEqual(window.shape[0], sample_rate // 2)
+        self.assertTrue(np.array_equal(window, samples[sample_rate:sample_rate * 3 // 2]))
+        self.assertAlmostEqual(window_length, audio_length)
+        self.assertAlmostEqual(audio_startstop[1], 1.5)
+
+        # The lazy time axis agrees with readFile's time array
+        self.assertEqual(len(time_axis), window.shape[0])
+        self.assertAlmostEqual(time_axis[0], 1.0)
+        self.assertTrue(np.allclose(np.asarray(time_axis), time_array[sample_rate:sample_rate * 3 // 2]))
+
+
+    def test_batch_analysis(self):
+        filenames = findWavFiles(TEST_AUDIO_DIR)
+        self.assertEqual([os.path.basename(name) for name in filenames],
+            ['orchestra.wav', 'piano.wav', 'stridor_sounds.wav', 'two_channel_test.wav'])
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            filename, n_frames, timings = analyzeFile(filenames[-1], [100, 2000], output_dir)
+            peaks = np.load(os.path.join(output_dir, 'two_channel_test.npz'))
+
+            self.assertEqual(peaks['peak_freqs'].shape, (n_frames, N_SPECTRAL_PEAKS))
+            self.assertEqual(peaks['times'].shape[0], n_frames)
+            self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
+
+        # Files with the same name in different directories keep separate outputs
+        self.assertEqual(outputNames(['a/x.wav', 'a/b/x.wav', 'a/c/x.wav']), ['x', os.path.join('b', 'x'), os.path.join('c', 'x')])
+
+        # A corrupt file is reported without losing the rest of the batch
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            good_filename = os.path.join(tmp_dir, 'good', 'piano.wav')
+            bad_filename = os.path.join(tmp_dir, 'corrupt', 'piano.wav')
+            for filename in (good_filename, bad_filename):
+                os.makedirs(os.path.dirname(filename))
+            shutil.copy(filenames[1], good_filename)
+            with open(bad_filename, 'wb') as f:
+                f.write(b'not a wav file')
+            output_dir = os.path.join(tmp_dir, 'output')
+            results, failures = runBatch([good_filename, bad_filename], [100, 2000], output_dir, workers=2)
+            self.assertEqual([filename for filename, _, _ in results], [good_filename])
+            self.assertEqual([filename for filename, _ in failures], [bad_filename])
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'good', 'piano.npz')))
+
+
+    def test_analyze(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        result = analyze(filename, [0, None], [100, 2000])
+
+        self.assertEqual(result.sample_rate, 44100)
+        self.assertAlmostEqual(result.audio_startstop[1], result.audio_length)
+        self.assertEqual(result.spectrogram.shape, (result.frequencies.shape[0], result.times.shape[0]))
+        self.assertEqual(result.peak_freqs.shape, (result.times.shape[0], N_SPECTRAL_PEAKS))
+        self.assertEqual(result.envelope.shape, result.envelope_times.shape)
+        self.assertTrue(np.nanmax(np.abs(result.envelope)) <= 1.5)
+
+        # Analysing a file never loads matplotlib
+        code = f'import sys, sound_analysis; sound_analysis.analyze({filename!r}, [0, None], [100, 2000]); print("matplotlib" in sys.modules)'
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')).stdout
+        self.assertEqual(output.strip(), 'False')
+
+
+    def test_spectrogram_cache(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'orchestra.wav')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SpectrogramCache(cache_dir)
+            first = cachedAnalyze(filename, [0, None], [100, 2000], cache)
+            second = cachedAnalyze(filename, [1, '2'], [100, 2000], cache)
+
+            # The second view is served from the memory-mapped cache entry
+            self.assertIsInstance(second.spectrogram, np.memmap)
+            self.assertTrue(np.array_equal(first.spectrogram, second.spectrogram))
+            self.assertEqual(second.audio_startstop, [1, 2.0])
+
+            # A different band is a different entry
+            self.assertNotEqual(cache.key(filename, [100, 2000]), cache.key(filename, [100, 1000]))
+
+            # Separate caches share file hashes, so a default cache does not re-read the file
+            hits = spectrogram_cache._fileHash.cache_info().hits
+            self.assertEqual(SpectrogramCache(cache_dir).key(filename, [100, 2000]), cache.key(filename, [100, 2000]))
+            self.assertEqual(spectrogram_cache._fileHash.cache_info().hits, hits + 2)
+
+            # Eviction keeps the cache within its size limit
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertIsNone(cache.load(cache.key(filename, [100, 2000])))
+
+
+    def test_envelope_pyramid(self):
+        # A single-sample spike in an hour of quiet audio
+        sample_rate = 1000
+        samples = np.zeros(sample_rate * 3600)
+        samples[1234567] = 1.0
+        samples[0] = -0.5
+        pyramid = EnvelopePyramid.build(samples, sample_rate)
+
+        # Each window is drawn from about ENVELOPE_POINTS blocks, at any zoom
+        for start, stop in [(0, 3600), (1000, 1500), (1200, 1300)]:
+            times, mins, maxs = pyramid.window(start, stop)
+            self.assertTrue(ENVELOPE_POINTS <= times.shape[0] <= ENVELOPE_POINTS * 4 + 1)
+            # ...and the spike is never smoothed away
+            self.assertEqual(maxs.max(), 1.0)
+
+        # Saved & restored pyramids give the same windows
+        meta, arrays = pyramid.toArrays()
+        restored = EnvelopePyramid.fromArrays(meta, arrays)
+        self.assertTrue(np.array_equal(restored.window(0, 10)[1], pyramid.window(0, 10)[1]))
+
+
+    def test_stft(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+        samples = butterBandpass(samples, [100, 2000], sample_rate)
+
+        # The engine reproduces scipy's spectrogram
+        expected = signal.spectrogram(samples, sample_rate, nperseg=NPERSEG, noverlap=NOVERLAP, window=SPEC_WINDOW)
+        for expected_array, array in zip(expected, stft(samples, sample_rate)):
+            self.assertTrue(np.allclose(expected_array, array))
+
+        # Short views get short segments, long views long ones
+        self.assertEqual(stftParameters(4410), (256, 252))
+        self.assertEqual(stftParameters(44100 * 3600), (MAX_NPERSEG, 0))
+
+        # A zoomed view only computes about TARGET_FRAMES frames, all near the view
+        frequencies, times, spectrogram = adaptiveSpectralAnalysis(samples, sample_rate, [1, 2])
+        self.assertTrue(TARGET_FRAMES <= times.shape[0] <= TARGET_FRAMES * 1.1)
+        self.assertTrue(0.99 <= times[0] and times[-1] <= 2.01)
+
+
+    def test_live_analysis(self):
+        # The ring buffer wraps around and counts overwritten samples
+        ring = RingBuffer(4)
+        ring.write(np.arange(3))
+        ring.write(np.arange(3, 6))
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual(list(ring.read(4)[0]), [2, 3, 4, 5])
+
+        # A block larger than the buffer keeps its end; the rest is dropped
+        ring.write(np.arange(2))
+        ring.write(np.arange(10, 17))
+        self.assertEqual((ring.written, ring.dropped), (15, 7))
+        self.assertEqual(list(ring.read(4)[0]), [13, 14, 15, 16])
+
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+        filtered = butterBandpass(samples, [100, 2000], sample_rate)
+
+        # Each column matches the offline spectrogram of the same segment
+        analyzer = LiveAnalyzer(sample_rate, [100, 2000])
+        results = [analyzer.process(samples[start:start + analyzer.hop])
+            for start in range(0, analyzer.hop * 4, analyzer.hop)]
+        self.assertIsNone(results[0])
+
+        end = analyzer.hop * 4
+        frequencies, times, spectrogram = stft(filtered[end - NPERSEG:end], sample_rate, NPERSEG, 0)
+        segment_time, column, peak_freqs, peak_intensities = results[-1]
+        self.assertTrue(np.allclose(column, spectrogram[:, 0]))
+        self.assertAlmostEqual(segment_time, (end - NPERSEG / 2) / sample_rate)
+        self.assertEqual(analyzer.stats()['hops'], 3)
+    
+    
+    def test_benchmarks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'synthetic.wav')
+            writeSyntheticWav(filename, 2, sample_rate=8000)
+            sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+            self.assertEqual((sample_rate, samples.shape[0]), (8000, 16000))
+
+            cases = {stage: (n, function) for stage, n, function in soundCases(filename)}
+            seconds, peak = measure(cases['butterBandpass'][1], repeats=1)
+            self.assertTrue(seconds > 0 and peak > 0)
+
+        # Only changes beyond the tolerance are flagged
+        baseline = {'stage:file': {'seconds': 1.0, 'peak_bytes': 100}}
+        self.assertEqual(compareBaseline({'stage:file': {'seconds': 1.2, 'peak_bytes': 100}}, baseline, 0.25), [])
+        self.assertEqual(len(compareBaseline({'stage:file': {'seconds': 1.3, 'peak_bytes': 200}}, baseline, 0.25)), 2)
+    
+    
+    def test_startup(self):
+        # The command line modules import quickly, leaving plotting & scipy for later
+        for module in STARTUP_MODULES:
+            seconds, loaded = measureStartup(module, repeats=1)
+            self.assertEqual(loaded, [], module)
+            self.assertLess(seconds, STARTUP_BUDGET, module)
+
+        # Without a display, plots are drawn with a headless backend
+        env = {name: value for name, value in os.environ.items() if name not in ('DISPLAY', 'WAYLAND_DISPLAY', 'MPLBACKEND')}
+        code = 'import sound_analysis, matplotlib; sound_analysis.plt.figure(); print(matplotlib.get_backend())'
+        output = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')).stdout
+        self.assertEqual(output.strip().lower(), 'agg')
+    
+    
+    def test_profiling(self):
+        # Without a Profiler, stages are not recorded
+        with profileStage('idle') as stage:
+            stage.arrays(x=np.zeros(3))
+
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        with Profiler() as profiler:
+            analyze(filename, [0, None], [100, 2000])
+            doRespAnalysis(os.path.join(TEST_BREATHING_DIR, 'millis_sample.txt'), None)
+
+        summary = summarizeTrace(json.loads(json.dumps(profiler.toChromeTrace())))
+        for name in ('read', 'filter', 'spectrogram', 'peaks', 'envelope', 'doRespAnalysis', 'phases'):
+            self.assertEqual(summary[name]['calls'], 1)
+        self.assertNotIn('idle', summary)
+
+        read = [event for event in profiler.events if event['name'] == 'read'][0]
+        self.assertGreater(read['args']['allocated_bytes'], 0)
+        self.assertEqual(read['args']['arrays']['samples']['dtype'], 'int16')
+        # The outer stage covers its nested stages
+        outer = [event for event in profiler.events if event['name'] == 'doRespAnalysis'][0]
+        self.assertTrue(all(outer['ts'] <= event['ts'] and event['ts'] + event['dur'] <= outer['ts'] + outer['dur']
+            for event in profiler.events if event['name'] == 'phases'))
+
+        # A missing trace filename is reported like the other argument errors
+        scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        for command in (['sound_analysis.py', filename, '0', '1', '100', '2000', '--profile'],
+                ['respiration_phase.py', 'millis_sample.txt', '--profile', '--resample']):
+            output = subprocess.run([sys.executable] + command, capture_output=True, text=True, cwd=scripts_dir)
+            self.assertNotEqual(output.returncode, 0)
+            self.assertIn('--profile must be followed by the trace filename', output.stderr)
+    
+    
+    def test_multi_channel(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'two_channel_test.wav')
+        result = analyze(filename, [0, None], [100, 2000], channels='all')
+        self.assertEqual(result.spectrogram.shape[0], 2)
+        self.assertEqual(result.peak_freqs.shape, (2, result.times.shape[0], N_SPECTRAL_PEAKS))
+
+        # Each channel matches analysing that channel on its own
+        for channel in range(2):
+            single = analyze(filename, [0, None], [100, 2000], channels=channel)
+            self.assertTrue(np.allclose(result.channel(channel).spectrogram, single.spectrogram))
+            self.assertTrue(np.array_equal(result.channel(channel).peak_freqs, single.peak_freqs, equal_nan=True))
+            self.assertTrue(np.array_equal(result.channel(channel).pyramid.maxs[0], single.pyramid.maxs[0]))
+            # Envelopes are scaled by each channel's own largest sample
+            self.assertTrue(np.allclose(result.channel(channel).pyramid.window(0, 1)[2], single.pyramid.window(0, 1)[2]))
+
+        sample_rate, samples = wavfile.read(filename)
+        self.assertTrue(np.array_equal(selectChannels(samples), samples[:, 1]))
+        self.assertTrue(np.allclose(selectChannels(samples, 'mean'), samples.mean(axis=1)))
+    
+    
+    def test_filter_modes(self):
+        # Filter designs are cached, and callers get their own copy
+        self.assertTrue(np.array_equal(designBandpass([100, 2000], 44100), designBandpass([100.0, 2000.0], 44100.0)))
+        self.assertIsNot(designBandpass([100, 2000], 44100), designBandpass([100, 2000], 44100))
+
+        filename = os.path.join(TEST_AUDIO_DIR, 'stridor_sounds.wav')
+        result = analyze(filename, [0, None], [100, 2000])
+        decimated = analyze(filename, [0, None], [100, 2000], decimate=True)
+
+        # Same frames & frequency resolution, up to the lower Nyquist frequency
+        n_freqs = decimated.frequencies.shape[0]
+        self.assertLess(decimated.frequencies[-1], result.frequencies[-1])
+        self.assertTrue(np.allclose(decimated.frequencies, result.frequencies[:n_freqs]))
+        self.assertTrue(np.allclose(decimated.times, result.times))
+
+        # Most of the band is within 0.1 dB, and peaks are nearly all the same
+        band = (decimated.frequencies >= 100) & (decimated.frequencies <= 2000)
+        reference = decibels(result.spectrogram[:n_freqs][band])
+        error = np.abs(reference - decibels(decimated.spectrogram[band]))
+        self.assertLess(np.median(error[reference > reference.max() - 60]), 0.1)
+        same = np.isclose(result.peak_freqs, decimated.peak_freqs) | np.isnan(result.peak_freqs) & np.isnan(decimated.peak_freqs)
+        self.assertGreater(same.mean(), 0.99)
+
+        # Zero-phase filtering does not delay a click
+        click = np.zeros(8192)
+        click[4096] = 1
+        filtered = butterBandpass(click, [100, 2000], 8000, zero_phase=True)
+        self.assertAlmostEqual(np.argmax(np.abs(filtered)), 4096, delta=1)
+    
+    
+    def test_peak_tracks(self):
+        times = np.arange(100) * 0.1
+        peak_freqs = np.full((100, N_SPECTRAL_PEAKS), np.nan)
+        peak_freqs[:, 0] = 500
+        # A tone gliding up at 10 Hz/s, and a blip too short to keep
+        peak_freqs[10:60, 1] = 800 + np.arange(50)
+        peak_freqs[70:72, 2] = 1500
+
+        table, point_tracks = trackPeaks(times, peak_freqs, np.ones_like(peak_freqs))
+        self.assertEqual(list(table['n_frames']), [100, 50])
+        self.assertTrue(np.allclose(table['start'], [0, 1]) and np.allclose(table['end'], [9.9, 5.9]))
+        self.assertTrue(np.allclose(table['slope'], [0, 10]))
+        self.assertTrue(np.allclose(table['mean_freq'], [500, 824.5]))
+        self.assertEqual(point_tracks[20, 1], 1)
+        self.assertEqual(point_tracks[70, 2], -1)
+
+        # Channels are tracked separately
+        table, point_tracks = trackPeaks(times, np.stack((peak_freqs, peak_freqs)), np.ones((2,) + peak_freqs.shape))
+        self.assertEqual(list(table['channel']), [0, 0, 1, 1])
+    
+    
+    def test_analysis_session(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'stridor_sounds.wav')
+        result = analyze(filename, [0, None], [100, 2000])
+
+        session = AnalysisSession(filename)
+        view = session.view([1, 2], [100, 2000])
+        # Only the frames of the window are computed, and match a full analysis
+        frames = np.searchsorted(result.times, view.times)
+        self.assertEqual(session.frames_computed, view.times.shape[0])
+        self.assertTrue(np.allclose(view.spectrogram, result.spectrogram[:, frames]))
+        self.assertTrue(np.array_equal(view.peak_freqs, result.peak_freqs[frames], equal_nan=True))
+
+        # Viewing inside what has been seen already computes nothing
+        work = (session.frames_computed, session.samples_filtered)
+        session.view([1.2, 1.8], [100, 2000])
+        self.assertEqual((session.frames_computed, session.samples_filtered), work)
+
+        # A new band is only filtered over the window
+        session.view([0, 1], [300, 1000])
+        self.assertLess(session.samples_filtered - work[1], 1.2 * session.sample_rate)
+
+        # Late in the recording too: only the window, its edge frames and a
+        # short warm-up are filtered, still matching a full analysis
+        session.view([18, 19], [100, 2000])
+        work = session.samples_filtered
+        view = session.view([18, 19], [300, 1500])
+        state = session.band([300, 1500])
+        filtered = session.samples_filtered - work
+        self.assertGreater(filtered, session.sample_rate)
+        self.assertLess(filtered, session.sample_rate + 3 * NPERSEG + state.warmup)
+        late = analyze(filename, [0, None], [300, 1500])
+        frames = np.searchsorted(late.times, view.times)
+        self.assertTrue(np.allclose(view.spectrogram, late.spectrogram[:, frames]))
+        self.assertEqual(view.envelope.shape, view.envelope_times.shape)
+        self.assertAlmostEqual(view.envelope_times[0], 18)
+
+        view = session.view([0, 'None'], [100, 2000])
+        self.assertEqual(view.audio_startstop[1], session.audio_length)
+        self.assertTrue(np.allclose(view.spectrogram, result.spectrogram))
+        self.assertTrue(np.allclose(view.envelope, result.envelope))
+    
+    
+    def test_feature_store(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'stridor_sounds.wav')
+        result = analyze(filename, [0, None], [100, 2000])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            resp_startstop = {'insp': np.array([[0.5, 1.5]]), 'exp': np.array([[1.5, 2.5]])}
+            exportAnalysis(os.path.join(tmp_dir, 'full'), result, resp_startstop, resp_offset=1.0)
+            store = FeatureStore(os.path.join(tmp_dir, 'full'))
+            peaks = store.read('peaks', 1, 2)
+            frames = (result.times >= 1) & (result.times <= 2)
+            self.assertTrue(np.array_equal(peaks['peak_freqs'], result.peak_freqs[frames], equal_nan=True))
+            self.assertTrue(np.allclose(store.read('spectrogram')['power'], result.spectrogram.T))
+            phases = store.read('resp_phases')
+            self.assertEqual(phases['phase'].tolist(), ['insp', 'exp'])
+            self.assertTrue(np.allclose(phases['start'], [1.5, 2.5]))
+
+            # Reading a time range only opens the chunks that overlap it
+            with FeatureWriter(os.path.join(tmp_dir, 'chunked'), chunk_rows=10) as writer:
+                for start in range(0, 100, 7):
+                    times = np.arange(start, min(start + 7, 100)) * 0.1
+                    writer.append('peaks', time=times, peak_freqs=times[:, None] * np.ones(4))
+            store = FeatureStore(os.path.join(tmp_dir, 'chunked'))
+            self.assertEqual(len(store.chunks('peaks', 2.5, 4.5)), 3)
+            self.assertTrue(np.allclose(store.read('peaks', 2.5, 4.5)['time'], np.arange(25, 46) * 0.1))
+
+            # Appending while streaming gives the same frames as a full analysis
+            exportStream(os.path.join(tmp_dir, 'stream'), filename, [100, 2000])
+            streamed = FeatureStore(os.path.join(tmp_dir, 'stream')).read('peaks')
+            self.assertTrue(np.allclose(streamed['time'], result.times))
+    
+    
+    def test_low_precision(self):
+        filename = os.path.join(TEST_AUDIO_DIR, 'stridor_sounds.wav')
+        result = analyze(filename, [0, None], [100, 2000])
+        low = analyze(filename, [0, None], [100, 2000], dtype=LOW_PRECISION_DTYPE)
+        self.assertEqual(low.spectrogram.dtype, np.float32)
+
+        # Within the band and 60 dB of the loudest bin, float32 is within 0.1 dB
+        reference = decibels(result.spectrogram)
+        error = np.abs(reference - decibels(low.spectrogram.astype(np.float64)))
+        band = (result.frequencies >= 100) & (result.frequencies <= 2000)
+        self.assertLess(error[band][reference[band] > reference.max() - 60].max(), 0.1)
+        self.assertTrue(np.array_equal(result.peak_freqs, low.peak_freqs, equal_nan=True))
+
+        # Filtering in place gives the same result
+        sample_rate, samples, audio_length, time_array, audio_startstop = readFile(filename, [0, None])
+        filtered = butterBandpass(samples, [100, 2000], sample_rate, LOW_PRECISION_DTYPE)
+        buffer = samples.astype(LOW_PRECISION_DTYPE)
+        self.assertIs(butterBandpass(buffer, [100, 2000], sample_rate, out=buffer), buffer)
+        self.assertTrue(np.array_equal(buffer, filtered))
     
     
     def test_calcHz(self):
+        # One reading per second (the rate used to be overestimated twofold)
         Hz = calcHz([0, 1000])
-        self.assertAlmostEqual(Hz, 2)
+        self.assertAlmostEqual(Hz, 1)
+
+        # Jittered intervals are averaged over the whole log
+        self.assertAlmostEqual(calcHz([0, 23, 47, 70, 93, 117]), 1000 / 23.4)
+
+
+    def test_resp_timing(self):
+        # Gaps and readings out of order are found, and left out of the rate
+        millis = np.arange(0, 2000, 20)
+        millis[50:] += 500
+        millis[70] = millis[69]
+        timing = analyzeTimestamps(millis)
+        self.assertEqual(timing['gaps'].tolist(), [49])
+        self.assertEqual(timing['backwards'].tolist(), [70])
+        self.assertAlmostEqual(timing['hz'], 50)
+        self.assertAlmostEqual(timing['gap_seconds'], 0.5)
+
+        # Nor is the interval after a reading that goes backwards a gap
+        millis[70] = millis[69] - 100
+        timing = analyzeTimestamps(millis)
+        self.assertEqual(timing['gaps'].tolist(), [49])
+        self.assertEqual(timing['backwards'].tolist(), [70])
+        self.assertAlmostEqual(timing['drift'], 0)
+
+        # An interval growing from 20 to 22 ms drifts by about a tenth
+        timing = analyzeTimestamps(np.cumsum(np.linspace(20, 22, 1001)))
+        self.assertAlmostEqual(timing['drift'], 0.1, places=2)
+
+        # Resampled readings are on a uniform grid, and give the same phases
+        filename = os.path.join(TEST_BREATHING_DIR, 'millis_sample.txt')
+        vals, time_list = readRespData(filename, resample=True)
+        self.assertIsInstance(time_list, TimeAxis)
+        self.assertEqual(vals.shape[0], len(time_list))
+        self.assertAlmostEqual(time_list.sample_rate, calcHz(parseRespLog(filename)[1]))
+        resampled = doRespAnalysis(filename, None, return_phases=True, resample=True)[-1]
+        original = doRespAnalysis(filename, None, return_phases=True)[-1]
+        for key in ('insp', 'exp'):
+            self.assertTrue(np.allclose(resampled[key][-2:], original[key][-2:], atol=0.03))
+
+
+    def test_read_resp_data(self):
+        # 'millis; value' logs give the real time of every reading
+        vals, time_list = readRespData(io.StringIO('846; 6\n873; 7\n896; 10\n'))
+        self.assertEqual(vals.tolist(), [6, 7, 10])
+        self.assertTrue(np.allclose(time_list, [0, 0.027, 0.05]))
+
+        # Bare values fall back to a fixed sampling rate
+        vals, time_list = readRespData(os.path.join(TEST_BREATHING_DIR, 'long_resp_data.txt'))
+        self.assertEqual(vals.shape, (8485,))
+        self.assertAlmostEqual(time_list[1], 1 / 11.7)
+
+
+    def test_live_respiration(self):
+        running_mean = RunningMean(3)
+        self.assertEqual([running_mean.push(value) for value in [3, 4, 8, 1]], [None, None, 5, 4])
+
+        filename = os.path.join(TEST_BREATHING_DIR, 'long_resp_data.txt')
+        vals, time_list = readRespData(filename)
+        diff, diff_time_vals = calcDifferential(runningMean(vals), time_list)
+        expected = findRespiratoryPhase(diff, diff_time_vals)
+
+        # Without hysteresis, the phases away from the ends are the offline ones
+        detector = PhaseDetector(hysteresis=0)
+        detector.processBlock(vals, time_list)
+        phases = detector.finish()
+        inside = lambda rows: rows[(rows[:, 0] > time_list[20]) & (rows[:, 1] < time_list[-20])]
+        for key in ('insp', 'exp'):
+            self.assertTrue(np.array_equal(inside(phases[key]), inside(expected[key])))
+
+        # Hysteresis merges the phases of small wobbles
+        detector = PhaseDetector()
+        events = detector.processBlock(vals, time_list)
+        self.assertLess(len(events), len(expected['insp']) + len(expected['exp']))
+        self.assertTrue(all(confirmed >= start for _, start, confirmed in events))
+
+        # A slow ramp, changing the mean by less than the hysteresis per
+        # reading, is confirmed once it has moved far enough overall
+        ramp = np.concatenate([np.arange(100, 120), np.arange(120, 100, -1), np.arange(100, 120)])
+        ramp_events = PhaseDetector(hysteresis=5).processBlock(ramp, np.arange(ramp.shape[0]) / 10)
+        self.assertEqual([phase for phase, _, _ in ramp_events], ['exp', 'insp'])
+        self.assertTrue(np.allclose([start for _, start, _ in ramp_events], [2.2, 4.1]))
+        self.assertTrue(np.allclose([confirmed for _, _, confirmed in ramp_events], [3.7, 5.6]))
+
+        # Replaying the log through the serial simulator gives the same phases
+        stream = io.StringIO()
+        simulateSerial(filename, stream, realtime=False)
+        stream.seek(0)
+        live = PhaseDetector()
+        live_events = [(phase, start, confirmed) for phase, start, confirmed, stats in liveRespAnalysis(stream, live)]
+        self.assertEqual([phase for phase, _, _ in live_events], [phase for phase, _, _ in events])
+        self.assertTrue(np.allclose([start for _, start, _ in live_events], [start for _, start, _ in events], atol=1e-3))
+        self.assertEqual(live.stats()['readings'], vals.shape[0])
+        self.assertGreater(live.stats()['latency_max_ms'], 0)
+
+
+    def test_binary_resp_log(self):
+        text_filename = os.path.join(TEST_BREATHING_DIR, 'millis_sample.txt')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Converted logs read back the same as the text log
+            binary_filename = os.path.join(tmp_dir, 'datalog.bin')
+            convertTextLog(text_filename, binary_filename)
+            header, vals, millis = readRespBinary(binary_filename)
+            self.assertEqual(header['start_millis'], 846)
+            self.assertIsInstance(vals, np.memmap)
+
+            text_vals, text_time_list = readRespData(text_filename)
+            binary_vals, binary_time_list = readRespData(binary_filename)
+            self.assertTrue(np.array_equal(text_vals, binary_vals))
+            self.assertTrue(np.array_equal(text_time_list, binary_time_list))
+
+            # Paths are detected too, and the readings stay mapped, unsigned
+            # values giving the same (signed) differentials
+            path_vals, _ = readRespData(pathlib.Path(binary_filename))
+            self.assertIsInstance(path_vals, np.memmap)
+            self.assertEqual(path_vals.dtype, np.uint16)
+            text_diff = calcDifferential(runningMean(text_vals), text_time_list)[0]
+            binary_diff = calcDifferential(runningMean(path_vals), binary_time_list)[0]
+            self.assertTrue(np.array_equal(text_diff, binary_diff))
+            self.assertLess(binary_diff.min(), 0)
+
+            # Simulated logs can be analysed like real ones
+            simulated_filename = os.path.join(tmp_dir, 'simulated.bin')
+            simulateLogger(simulated_filename, 30, seed=0)
+            vals, running, time_list, diff, diff_time_vals = doRespAnalysis(simulated_filename, (0, 30))
+            self.assertEqual(vals.shape[0], 1500)
+            self.assertTrue(np.all(np.diff(time_list) > 0))
+
+
+    def test_fused_analysis(self):
+        # Times outside every interval are not assigned to a phase
+        starts = np.array([0.0, 2.0, 5.0])
+        ends = np.array([1.5, 4.0, 6.0])
+        times = np.array([-1.0, 0.5, 1.8, 2.0, 4.5, 5.5, 7.0])
+        self.assertEqual(assignFrames(times, starts, ends).tolist(), [-1, 0, -1, 1, -1, 2, -1])
+
+        table, summary = doFusedAnalysis(os.path.join(TEST_AUDIO_DIR, 'stridor_sounds.wav'),
+            os.path.join(TEST_BREATHING_DIR, 'millis_sample.txt'), [100, 2000], resp_offset=1.5)
+        self.assertEqual(set(table['phase']), {'insp', 'exp'})
+        self.assertEqual(summary['insp']['n_frames'] + summary['exp']['n_frames'], table['n_frames'].sum())
+        self.assertTrue(summary['insp']['mean_energy'] > 0)
+
+
+    def test_time_index(self):
+        # Jittered timestamps use binary search
+        time_index = TimeIndex([0.0, 0.027, 0.05, 0.073, 0.1])
+        self.assertEqual(time_index.nearest(0.06), 2)
+        self.assertEqual(time_index.nearest(-1), 0)
+        self.assertEqual(time_index.nearest(5), 4)
+        self.assertEqual(time_index.range(0.02, 0.073), (1, 4))
+        self.assertEqual(indexOfClosest([0.0, 0.027, 0.05], 0.04), 2)
+
+        # Uniform sampling uses arithmetic, with the same results
+        time_axis = TimeAxis(10, 50, start_index=20)
+        time_index = TimeIndex(np.asarray(time_axis))
+        for t in [0, 2.04, 2.05, 3.33, 6.95, 9]:
+            self.assertEqual(time_axis.nearest(t), time_index.nearest(t))
+        self.assertEqual(time_axis.range(2.5, 3.0), time_index.range(2.5, 3.0))
+        self.assertEqual(time_axis.range(2.5, 3.0), (5, 11))
+
+
+    def test_find_respiratory_phase(self):
+        diff = np.array([1, 2, 0, 3, -1, -2, 0, 0, -1, 4, 5, -3])
+        diff_time_vals = np.arange(diff.shape[0]) * 0.5
+
+        resp_startstop = findRespiratoryPhase(diff, diff_time_vals)
+
+        # Zeros do not split a phase; each phase is widened by one
+        # sample on both sides, and phases touching either end are dropped
+        self.assertEqual(resp_startstop['insp'].tolist(), [[4.0, 5.5]])
+        self.assertEqual(resp_startstop['exp'].tolist(), [[1.5, 4.5]])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
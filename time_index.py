@@ -0,0 +1,108 @@
+"""
+Time indexes for finding samples by time without scanning the whole
+recording. TimeIndex does binary searches over any sorted array of
+sample times (e.g. FSR readings with jittered timestamps); TimeAxis
+does the same lookups with plain arithmetic for uniformly sampled
+signals (e.g. wav audio) and never stores the times at all.
+"""
+
+import numpy as np
+
+
+class TimeIndex:
+    """
+    Nearest-sample and time-range lookups over a sorted array of
+    sample times, in O(log n) per lookup.
+    """
+
+    def __init__(self, times):
+        self.times = np.asarray(times, dtype=float)
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def __getitem__(self, key):
+        return self.times[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.times.astype(dtype) if dtype is not None else self.times
+
+    def nearest(self, t):
+        """
+        Return the index of the sample closest to time t (a number or an
+        array of times). Ties go to the earlier sample.
+        """
+        # The samples either side of t
+        right = np.clip(np.searchsorted(self.times, t), 0, len(self) - 1)
+        left = np.maximum(right - 1, 0)
+
+        # Use the earlier sample unless the later one is strictly closer
+        index = np.where(np.abs(self.times[right] - t) < np.abs(t - self.times[left]), right, left)
+
+        return int(index) if np.ndim(index) == 0 else index
+
+    def range(self, start, stop):
+        """
+        Return the (first, last + 1) indices of the samples with
+        start <= time <= stop, i.e. the bounds of a slice.
+        """
+        first = int(np.searchsorted(self.times, start, side='left'))
+        last = int(np.searchsorted(self.times, stop, side='right'))
+
+        return first, max(first, last)
+
+
+class TimeAxis(TimeIndex):
+    """
+    Time (in s) of every sample of a uniformly sampled signal. Values are
+    computed from the sample rate when indexed rather than stored, so the
+    axis of a long recording costs no memory, and lookups by time are
+    O(1) arithmetic.
+    """
+
+    def __init__(self, sample_rate, n_samples, start_index=0):
+        self.sample_rate = sample_rate
+        self.n_samples = n_samples
+        # Index of the first sample within the whole recording
+        self.start_index = start_index
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = np.arange(*key.indices(self.n_samples))
+            return (self.start_index + indices) / self.sample_rate
+
+        # Support negative indices like a regular array
+        if key < 0:
+            key += self.n_samples
+        if not 0 <= key < self.n_samples:
+            raise IndexError("TimeAxis index out of range.")
+        return (self.start_index + key) / self.sample_rate
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype) if dtype is not None else self[:]
+
+    @property
+    def times(self):
+        return self[:]
+
+    def _position(self, t):
+        """
+        Fractional sample index of time t, rounded to absorb
+        floating point error in t * sample_rate.
+        """
+        return np.round(np.asarray(t, dtype=float) * self.sample_rate - self.start_index, 6)
+
+    def nearest(self, t):
+        # Round halves down, so ties go to the earlier sample
+        index = np.clip(np.ceil(self._position(t) - 0.5), 0, self.n_samples - 1).astype(int)
+
+        return int(index) if np.ndim(index) == 0 else index
+
+    def range(self, start, stop):
+        first = int(np.clip(np.ceil(self._position(start)), 0, self.n_samples))
+        last = int(np.clip(np.floor(self._position(stop)) + 1, 0, self.n_samples))
+
+        return first, max(first, last)